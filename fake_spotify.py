@@ -0,0 +1,372 @@
+"""
+fake_spotify.py
+
+Runs a local stand-in for the Spotify API endpoints Reverb uses, serving a
+synthetic catalog with configurable latency and error injection, so load tests
+and benchmarks can run offline. Point Reverb at it with:
+
+    SPOTIFY_ENDPOINT=http://127.0.0.1:<port>/v1/
+    SPOTIFY_TOKEN_URL=http://127.0.0.1:<port>/api/token
+"""
+
+#!/usr/bin/env python
+
+import sys
+import time
+import random
+import string
+import argparse
+import threading
+from collections import Counter
+
+from flask import Flask, request, jsonify, make_response
+
+BASE62 = string.ascii_letters + string.digits
+
+WORDS = ["midnight", "echo", "river", "neon", "golden", "static", "velvet", "ghost",
+         "summer", "paper", "electric", "honey", "silver", "wild", "blue", "fire",
+         "ocean", "city", "dream", "broken", "heart", "light", "shadow", "road",
+         "rain", "moon", "sugar", "glass", "thunder", "garden", "youth", "stars"]
+
+# Most ids accepted by one several tracks/albums request
+MAX_IDS = {"tracks": 50, "albums": 20}
+
+class Catalog:
+    """Synthetic catalog of albums with artists and tracks, generated from a seed."""
+    def __init__(self, n_albums=2000, tracks_per_album=10, seed=0):
+        rng = random.Random(seed)
+
+        artists = [self._artist(rng) for _ in range(max(1, n_albums // 4))]
+
+        self.albums = {}
+        self.tracks = {}
+
+        for _ in range(n_albums):
+            album = {
+                "id": self._id(rng),
+                "type": "album",
+                "name": self._title(rng),
+                "artists": [rng.choice(artists)],
+                "popularity": rng.randint(0, 100),
+                "tracks": []
+            }
+            self.albums[album["id"]] = album
+
+            for _ in range(tracks_per_album):
+                track = {
+                    "id": self._id(rng),
+                    "type": "track",
+                    "name": self._title(rng),
+                    "artists": album["artists"],
+                    "popularity": rng.randint(0, 100),
+                    "album_id": album["id"]
+                }
+                self.tracks[track["id"]] = track
+                album["tracks"].append(track["id"])
+
+    @staticmethod
+    def _id(rng):
+        return "".join(rng.choice(BASE62) for _ in range(22))
+
+    @staticmethod
+    def _title(rng):
+        return " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 3))).title()
+
+    def _artist(self, rng):
+        return {"id": self._id(rng), "name": self._title(rng), "type": "artist"}
+
+    def album_json(self, album_id, base_url):
+        """Album object in the shape of the Spotify API"""
+        album = self.albums[album_id]
+
+        return {
+            "id": album["id"],
+            "type": "album",
+            "name": album["name"],
+            "artists": album["artists"],
+            "popularity": album["popularity"],
+            "images": [{"url": f"{base_url}image/{album['id']}/{size}",
+                        "height": size, "width": size} for size in (640, 300, 64)]
+        }
+
+    def track_json(self, track_id, base_url):
+        """Track object in the shape of the Spotify API"""
+        track = self.tracks[track_id]
+
+        return {
+            "id": track["id"],
+            "type": "track",
+            "name": track["name"],
+            "artists": track["artists"],
+            "popularity": track["popularity"],
+            "album": self.album_json(track["album_id"], base_url)
+        }
+
+    def search(self, query, content_type):
+        """Ids of tracks or albums whose name matches the query, most popular first"""
+        items = self.tracks if content_type == "track" else self.albums
+
+        # Random searches like %a% match on the letters alone
+        terms = query.replace("%", " ").lower().split()
+
+        matches = [item for item in items.values()
+                   if all(term in item["name"].lower() for term in terms)]
+        matches.sort(key=lambda item: item["popularity"], reverse=True)
+
+        return [item["id"] for item in matches]
+
+class Behavior:
+    """Injected latency and errors for every API request."""
+    def __init__(self, latency="fixed", latency_ms=50.0, error_rate=0.0,
+                 rate_limit_rate=0.0, retry_after=1, seed=None):
+        self.latency = latency
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self):
+        """Seconds to sleep before answering, drawn from the configured distribution"""
+        mean = self.latency_ms / 1000
+
+        with self._lock:
+            if self.latency == "uniform":
+                return self._rng.uniform(0, 2 * mean)
+
+            if self.latency == "exponential":
+                return self._rng.expovariate(1 / mean) if mean > 0 else 0
+
+            if self.latency == "lognormal":
+                # Median at the configured latency with a long tail
+                return mean * self._rng.lognormvariate(0, 0.75)
+
+            return mean
+
+    def fault(self):
+        """Status code of an injected failure, or None"""
+        with self._lock:
+            roll = self._rng.random()
+
+        if roll < self.rate_limit_rate:
+            return 429
+
+        if roll < self.rate_limit_rate + self.error_rate:
+            return 503
+
+        return None
+
+def create_app(catalog, behavior, token_lifetime=3600):
+    """Flask app serving the fake Spotify API"""
+    app = Flask(__name__)
+
+    counters = Counter()
+    tokens = {}
+    lock = threading.Lock()
+
+    def count(name):
+        with lock:
+            counters[name] += 1
+
+    def error(status, message, headers=None):
+        response = make_response(jsonify({"error": {"status": status, "message": message}}),
+                                 status)
+
+        for key, value in (headers or {}).items():
+            response.headers[key] = value
+
+        return response
+
+    @app.before_request
+    def inject():
+        if request.path.startswith("/_") or request.path.startswith("/image/"):
+            return None
+
+        count("requests")
+        count(request.endpoint or "unknown")
+
+        time.sleep(behavior.delay())
+
+        status = behavior.fault()
+        if status == 429:
+            return error(429, "API rate limit exceeded", {"Retry-After": str(behavior.retry_after)})
+        if status:
+            return error(status, "Service unavailable")
+
+        if request.path.startswith("/v1/"):
+            auth = request.headers.get("Authorization", "")
+            token = auth[len("Bearer "):] if auth.startswith("Bearer ") else None
+
+            with lock:
+                expires_at = tokens.get(token)
+
+            if expires_at is None or expires_at < time.time():
+                return error(401, "The access token expired")
+
+        return None
+
+    @app.after_request
+    def count_status(response):
+        if not request.path.startswith("/_") and not request.path.startswith("/image/"):
+            count(f"status_{response.status_code}")
+
+        return response
+
+    @app.route("/api/token", methods=["POST"])
+    def token():
+        if request.form.get("grant_type") != "client_credentials":
+            return error(400, "unsupported_grant_type")
+
+        access_token = "".join(random.choice(BASE62) for _ in range(40))
+
+        with lock:
+            tokens[access_token] = time.time() + token_lifetime
+
+        return jsonify({"access_token": access_token, "token_type": "Bearer",
+                        "expires_in": token_lifetime})
+
+    @app.route("/v1/search", methods=["GET"])
+    def search():
+        query = request.args.get("q", "")
+        content_type = request.args.get("type", "")
+        limit = min(int(request.args.get("limit", 20)), 50)
+        offset = int(request.args.get("offset", 0))
+
+        if not query or content_type not in ("track", "album"):
+            return error(400, "Invalid search query")
+
+        ids = catalog.search(query, content_type)
+        page = ids[offset:offset + limit]
+        to_json = catalog.track_json if content_type == "track" else catalog.album_json
+
+        return jsonify({content_type + "s": {
+            "items": [to_json(content_id, request.host_url) for content_id in page],
+            "limit": limit,
+            "offset": offset,
+            "total": len(ids)
+        }})
+
+    def several(content_type_plural):
+        ids = [content_id for content_id in request.args.get("ids", "").split(",") if content_id]
+
+        if not ids or len(ids) > MAX_IDS[content_type_plural]:
+            return error(400, "Invalid number of ids")
+
+        if any(len(content_id) != 22 or set(content_id) - set(BASE62) for content_id in ids):
+            return error(400, "invalid id")
+
+        items = catalog.tracks if content_type_plural == "tracks" else catalog.albums
+        to_json = catalog.track_json if content_type_plural == "tracks" else catalog.album_json
+
+        return jsonify({content_type_plural: [
+            to_json(content_id, request.host_url) if content_id in items else None
+            for content_id in ids
+        ]})
+
+    def single(content_type_plural, content_id):
+        items = catalog.tracks if content_type_plural == "tracks" else catalog.albums
+        to_json = catalog.track_json if content_type_plural == "tracks" else catalog.album_json
+
+        if len(content_id) != 22 or set(content_id) - set(BASE62):
+            return error(400, "invalid id")
+
+        if content_id not in items:
+            return error(404, "Resource not found")
+
+        return jsonify(to_json(content_id, request.host_url))
+
+    @app.route("/v1/tracks", methods=["GET"])
+    def several_tracks():
+        return several("tracks")
+
+    @app.route("/v1/albums", methods=["GET"])
+    def several_albums():
+        return several("albums")
+
+    @app.route("/v1/tracks/<content_id>", methods=["GET"])
+    def one_track(content_id):
+        return single("tracks", content_id)
+
+    @app.route("/v1/albums/<content_id>", methods=["GET"])
+    def one_album(content_id):
+        return single("albums", content_id)
+
+    @app.route("/image/<content_id>/<int:size>", methods=["GET"])
+    def image(content_id, size):
+        # Solid color square derived from the id
+        color = "#" + "".join(f"{ord(c) * 7 % 256:02x}" for c in content_id[:3])
+        svg = (f'<svg xmlns="http://www.w3.org/2000/svg" width="{size}" height="{size}">'
+               f'<rect width="100%" height="100%" fill="{color}"/></svg>')
+
+        response = make_response(svg)
+        response.headers["Content-Type"] = "image/svg+xml"
+        return response
+
+    @app.route("/_stats", methods=["GET"])
+    def stats():
+        """Request counters by endpoint and injected/error status"""
+        with lock:
+            return jsonify(dict(counters))
+
+    @app.route("/_stats/reset", methods=["POST"])
+    def reset_stats():
+        with lock:
+            counters.clear()
+
+        return jsonify({})
+
+    @app.route("/_config", methods=["POST"])
+    def configure():
+        """Change latency and error injection while running, e.g. mid-benchmark"""
+        for key in ("latency", "latency_ms", "error_rate", "rate_limit_rate", "retry_after"):
+            if key in request.form:
+                value = request.form[key]
+                setattr(behavior, key, value if key == "latency" else float(value))
+
+        return jsonify({key: getattr(behavior, key) for key in
+                        ("latency", "latency_ms", "error_rate", "rate_limit_rate", "retry_after")})
+
+    return app
+
+def get_args():
+    """Returns command line arguments."""
+    parser = argparse.ArgumentParser(description="Local stand-in for the Spotify API")
+
+    parser.add_argument("port", type=int, help="the port at which the server should listen")
+    parser.add_argument("--albums", type=int, default=2000, help="albums in the catalog")
+    parser.add_argument("--tracks-per-album", type=int, default=10, help="tracks per album")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the catalog and faults")
+    parser.add_argument("--latency", choices=["fixed", "uniform", "exponential", "lognormal"],
+                        default="fixed", help="latency distribution")
+    parser.add_argument("--latency-ms", type=float, default=50.0,
+                        help="mean (median for lognormal) latency in milliseconds")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of requests answered with 503")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0,
+                        help="fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1,
+                        help="Retry-After seconds sent with 429 responses")
+    parser.add_argument("--token-lifetime", type=int, default=3600,
+                        help="seconds until issued tokens expire")
+
+    return parser.parse_args()
+
+def main():
+    """Main function for the fake Spotify server."""
+    args = get_args()
+
+    catalog = Catalog(args.albums, args.tracks_per_album, args.seed)
+    behavior = Behavior(args.latency, args.latency_ms, args.error_rate,
+                        args.rate_limit_rate, args.retry_after, args.seed)
+
+    app = create_app(catalog, behavior, args.token_lifetime)
+
+    try:
+        app.run(host="127.0.0.1", port=args.port, threaded=True)
+    except Exception as ex:
+        print(ex, file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -14,26 +14,30 @@ from flask import Flask, request, make_response, redirect, url_for, render_templ
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 
 # To-do: move direct handling of db into database.py
-from utils.models import Users, Friendships, ReviewContent, JournalEntryContent
+from utils.models import Users, Friendships
 
 from utils.database import db_init, create_user, update_profile, create_friendship,\
     accept_friendship, reject_friendship, remove_friendship, is_friend, get_friends,\
-    get_user_by_id, get_reverb_results, get_collections_by_user_id, get_random_friend,\
-    get_random_user, get_most_reviewed_content
+    get_pending_friends, get_user_by_id, get_collections_by_user_id, get_random_friend,\
+    get_random_user, get_top_content_keys, search_review_text, content_loader
 
 from utils.database import create_collection, add_content_to_collection,\
     get_collection_content, delete_content_from_collection,\
     get_random_collection, get_collection_by_id, delete_collection,\
     set_favorite_content, get_favorite_content
 
-from utils.database import get_reviews_by_user_id, get_reviews_by_content_id, post_review,\
-    get_friend_count, get_number_of_reviews_by_user
+from utils.database import get_reviews_by_content_id, post_review,\
+    get_friend_count, rebuild_user_stats, rebuild_content_stats, get_content_stats
+
+from utils.database import get_profile_view, get_profile_reviews, get_profile_journal_entries
 
 from utils.database import post_journal_entry, get_journal_entries_by_user_and_content,\
-    get_journal_entries_by_user, edit_entry, delete_entry, delete_review
+    edit_entry, delete_entry, delete_review
+
+from utils.spotify import get_content_info, get_random_content,\
+    latency_budget, SpotifyError, content_pool
 
-from utils.spotify import get_spotify_results, get_content_info,\
-    get_content_several_ids, get_random_content
+from utils.search import search_all
 
 from utils.form_utils import EditProfileForm, AddToCollectionForm,\
     CreateCollectionForm, DeleteCollectionForm, password_strength_check
@@ -42,14 +46,30 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 
 app = Flask(__name__, template_folder="html")
 
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(basedir, "reverb.db")
+# Defaults to reverb.db next to this file; tests point it at a scratch database
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
+    "REVERB_DATABASE_URI", "sqlite:///" + os.path.join(basedir, "reverb.db"))
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY")
 
+# Items per page in each profile tab
+PROFILE_PAGE_SIZE = int(os.environ.get("PROFILE_PAGE_SIZE", "20"))
+
 db_init(app)
+
+# Fill the random content pool in the background, so pages never wait for it
+content_pool.start()
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = "login"
 
+@app.cli.command("rebuild-stats")
+def rebuild_stats():
+    """Recompute every user's profile counters and content's review aggregates."""
+    rebuild_user_stats()
+    rebuild_content_stats()
+    print("User and content stats rebuilt.")
+
 @login_manager.user_loader
 def load_user(user_id):
     """Load specified user."""
@@ -142,6 +162,7 @@ def login():
 
 @app.route("/home", methods=["GET"])
 @login_required
+@latency_budget()
 def home():
     """Reverb home page (user feed) content."""
     current_user_id = current_user.get_id()
@@ -151,19 +172,25 @@ def home():
 
     # Random top Spotify content
     slides = get_random_content("track", 5)
-    album = get_random_content("album", 1)[0]
+    albums = get_random_content("album", 1)
+    album = albums[0] if albums else None
     collection = get_random_collection()
 
-    # Top Reverb content
-    top_content = get_most_reviewed_content()
+    # Trending Reverb content
+    top_keys = get_top_content_keys()
 
     # Top friends content
     friends = get_friend_count(current_user_id)
-    friend_content = []
+    friend_keys = []
 
     if friends > 0:
         the_friend = get_random_friend(current_user_id)
-        friend_content = get_most_reviewed_content(the_friend.get_id())
+        friend_keys = get_top_content_keys(the_friend.get_id())
+
+    # Metadata for both feeds in one batch
+    content = content_loader().load_many(top_keys + friend_keys)
+    top_content = [content[key] for key in top_keys if key in content]
+    friend_content = [content[key] for key in friend_keys if key in content]
 
     html = render_template("home.html",
                            current_user=current_user_obj,
@@ -186,6 +213,7 @@ def display_profiles():
 
 @app.route("/user/<int:user_id>", methods=["GET"])
 @login_required
+@latency_budget()
 def display_profile(user_id):
     """Display user profile"""
     current_user_id = current_user.get_id()
@@ -193,69 +221,75 @@ def display_profile(user_id):
 
     random_user = get_random_user(current_user_id)
 
-    user = get_user_by_id(user_id)
+    # First page of each tab, the rest is loaded by profile_tab
+    profile = get_profile_view(user_id, current_user_id, PROFILE_PAGE_SIZE)
 
-    if not user:
+    if not profile:
         return not_found("User not found.")
 
-    # User reviews
-    reviews, content = get_reviews_by_user_id(user_id)
-
-    # get list of reviews in same order as content
-    reviews_list = []
-    for r in reviews["tracks"]:
-        reviews_list.append(r)
-
-    for r in reviews["albums"]:
-        reviews_list.append(r)
-
-    content_items = get_content_several_ids(content)
-
-    friends, pending_sent, pending_received = get_friends(user_id)
-
-    reviews_content = []
-    count = len(reviews_list)
-
-    for i in range(count):
-        r = reviews_list[i]
-        c = content_items[i]
+    html = render_template("profile.html",
+                            current_user=current_user_obj,
+                            random_user=random_user,
+                            user=profile.user,
+                            reviews=profile.reviews,
+                            results=profile.collections,
+                            journal_entries=profile.journal_entries,
+                            friends=profile.friends,
+                            pending_friends_sent=profile.pending_friends_sent,
+                            pending_friends_received=profile.pending_friends_received,
+                            friends_count=profile.stats.friend_count,
+                            reviews_count=profile.stats.review_count,
+                            next_reviews=profile.next_reviews,
+                            next_collections=profile.next_collections,
+                            next_friends=profile.next_friends,
+                            next_pending_friends_sent=profile.next_pending_friends_sent,
+                            next_pending_friends_received=profile.next_pending_friends_received,
+                            next_journal_entries=profile.next_journal_entries)
 
-        review = ReviewContent(c.image, c.name, c.artists,
-                                c.content_type, c.content_id,
-                                r.rating, r.text)
-        reviews_content.append(review)
+    response = make_response(html)
 
-    # User collections
-    collections = get_collections_by_user_id(user_id)
+    return response
 
-    # Follows the same pattern as above
-    journal_entries, journal_content = get_journal_entries_by_user(user_id)
-    journal_content_items= get_content_several_ids(journal_content)
+@app.route("/user/<int:user_id>/<tab>", methods=["GET"])
+@login_required
+@latency_budget()
+def profile_tab(user_id, tab):
+    """Next page of a profile tab, to append to the tab."""
+    current_user_obj = get_user_by_id(current_user.get_id())
 
-    journal_entries_content =[]
-    count = len(journal_entries)
+    user = get_user_by_id(user_id)
 
-    friends_count = get_friend_count(user_id)
-    reviews_count = get_number_of_reviews_by_user(user_id)
+    if not user:
+        return not_found("User not found.")
 
-    for i in range(count):
-        r = journal_entries[i]
-        c = journal_content_items[i]
-        entry = JournalEntryContent(c.image, c.name, c.content_type, c.content_id, r.text)
-        journal_entries_content.append(entry)
+    before = request.args.get("before", type=int)
+    items = {}
+
+    if tab == "reviews":
+        items["reviews"], next_page = get_profile_reviews(user_id, before, PROFILE_PAGE_SIZE)
+    elif tab == "collections":
+        items["results"], next_page = get_collections_by_user_id(user_id, before,
+                                                                 PROFILE_PAGE_SIZE)
+    elif tab == "friends":
+        items["friends"], next_page = get_friends(user_id, before, PROFILE_PAGE_SIZE)
+    elif tab in ("pending_friends_sent", "pending_friends_received") and \
+            user.id == current_user_obj.id:
+        items[tab], next_page = get_pending_friends(user_id, tab == "pending_friends_sent",
+                                                    before, PROFILE_PAGE_SIZE)
+        items["next_" + tab] = next_page
+    elif tab == "journal_entries" and user.id == current_user_obj.id:
+        items["journal_entries"], next_page = get_profile_journal_entries(user_id, before,
+                                                                          PROFILE_PAGE_SIZE)
+    else:
+        return not_found("Invalid profile tab.")
 
-    html = render_template("profile.html",
-                            current_user=current_user_obj,
-                            random_user=random_user,
-                            user=user,
-                            reviews=reviews_content,
-                            results=collections,
-                            journal_entries=journal_entries_content,
-                            friends=friends,
-                            pending_friends_sent=pending_sent,
-                            pending_friends_received=pending_received,
-                            friends_count=friends_count,
-                            reviews_count=reviews_count)
+    html = render_template("profile_tab.html",
+                           current_user=current_user_obj,
+                           user=user,
+                           tab=tab,
+                           next_page=next_page,
+                           continued=True,
+                           **items)
 
     response = make_response(html)
 
@@ -263,6 +297,7 @@ def display_profile(user_id):
 
 @app.route("/edit_profile/<int:user_id>", methods=["GET", "POST"])
 @login_required
+@latency_budget()
 def edit_profile(user_id):
     """Profile editing page cteont."""
     current_user_id = current_user.get_id()
@@ -278,18 +313,12 @@ def edit_profile(user_id):
 
     form = EditProfileForm(bio=current_user.bio, favorite_genre=current_user.favorite_genre)
 
-    # User favorite track/album
-    track = None
-
-    if user.favorite_track:
-        track = get_content_info("track", user.favorite_track)
-
-    album = None
-
-    if user.favorite_album:
-        album = get_content_info("album", user.favorite_album)
+    # User favorite track/album in one batch, left out if Spotify cannot answer in time
+    favorites = [("track", user.favorite_track), ("album", user.favorite_album)]
+    favorites = [key for key in favorites if key[1]]
 
-    results = [result for result in [track, album] if result]
+    content = content_loader().load_many(favorites)
+    results = [content[key] for key in favorites if key in content]
 
     # Update changes
     if form.validate_on_submit():
@@ -375,7 +404,7 @@ def submit_review(content_type, content_id):
 def get_search_results():
     """Helper function for getting search results."""
     # Content types
-    filters = {"track": None, "album": None, "user": None, "collection": None}
+    filters = {"track": None, "album": None, "user": None, "collection": None, "text": None}
 
     for key in filters:
         filters[key] = request.args.get(key)
@@ -388,10 +417,7 @@ def get_search_results():
     # Retrieve Spotify & Reverb results
     results = ""
     if query:
-        spotify_results = get_spotify_results(query, filters["track"], filters["album"])
-        reverb_results = get_reverb_results(query, filters["user"], filters["collection"])
-
-        results = spotify_results + reverb_results
+        results = search_all(query, filters)
 
     # Filter results based on selected content types
     filtered_results = []
@@ -400,10 +426,16 @@ def get_search_results():
         if filters[result.content_type] == "true":
             filtered_results.append(result)
 
-    return query, filtered_results
+    # First page of reviews and journal entries mentioning the query
+    text_results, more_text_results = [], False
+    if query and filters["text"] == "true":
+        text_results, more_text_results = search_review_text(query, current_user.get_id())
+
+    return query, filtered_results, text_results, more_text_results
 
 @app.route("/search", methods=["GET"])
 @login_required
+@latency_budget()
 def search():
     """Search page content for the Reverb application."""
     current_user_id = current_user.get_id()
@@ -411,13 +443,16 @@ def search():
 
     random_user = get_random_user(current_user_id)
 
-    query, results = get_search_results()
+    query, results, text_results, more_text_results = get_search_results()
 
     html = render_template("search.html",
                            query=query,
                            current_user=current_user_obj,
                            random_user=random_user,
-                           results=results)
+                           results=results,
+                           text_results=text_results,
+                           more_text_results=more_text_results,
+                           page=1)
 
     response = make_response(html)
 
@@ -425,13 +460,37 @@ def search():
 
 @app.route("/search_results", methods=["GET"])
 @login_required
+@latency_budget()
 def search_results():
     """Search results content for the Reverb application."""
-    query, results = get_search_results()
+    query, results, text_results, more_text_results = get_search_results()
 
     html = render_template("search_results.html",
                            query=query,
-                           results=results)
+                           results=results,
+                           text_results=text_results,
+                           more_text_results=more_text_results,
+                           page=1)
+
+    response = make_response(html)
+
+    return response
+
+@app.route("/search_text", methods=["GET"])
+@login_required
+@latency_budget()
+def search_text():
+    """Further pages of review and journal entry search results."""
+    query = request.args.get("query", "")
+    page = max(1, request.args.get("page", 1, type=int))
+
+    text_results, more_text_results = search_review_text(query, current_user.get_id(), page)
+
+    html = render_template("text_results.html",
+                           query=query,
+                           text_results=text_results,
+                           more_text_results=more_text_results,
+                           page=page)
 
     response = make_response(html)
 
@@ -439,6 +498,7 @@ def search_results():
 
 @app.route("/content/<content_type>/<content_id>", methods=["GET", "POST"])
 @login_required
+@latency_budget()
 def content(content_type, content_id):
     """Display corresponding content page after clicking search result"""
     current_user_id = current_user.get_id()
@@ -463,7 +523,7 @@ def content(content_type, content_id):
             return not_found(f"{content_type} with id {content_id} does not exist")
 
         # get existing colletions to populate dropdown menu
-        collections = get_collections_by_user_id(current_user_id)
+        collections, _ = get_collections_by_user_id(current_user_id)
 
         addform = AddToCollectionForm()
         addform.dropdown.choices = [(c.content_id, c.name) for c in collections]
@@ -487,7 +547,9 @@ def content(content_type, content_id):
 
             return redirect(url_for("content", content_type=content_type, content_id=content_id))
 
-        reviews = get_reviews_by_content_id(content_type, content_id)
+        # First page of reviews, and rating statistics over all of them
+        reviews, next_reviews = get_reviews_by_content_id(content_type, content_id)
+        stats = get_content_stats(content_type, content_id)
 
         html = render_template("content.html",
                             content_type=content_type,
@@ -498,7 +560,9 @@ def content(content_type, content_id):
                             addform=addform,
                             createform=createform,
                             collections=collections,
-                            reviews=reviews)
+                            reviews=reviews,
+                            next_reviews=next_reviews,
+                            stats=stats)
 
     # Collection
     elif content_type == "collection":
@@ -566,6 +630,15 @@ def get_journal_entries(content_id):
     entries = get_journal_entries_by_user_and_content(current_user_id, content_id)
     return jsonify([entry.to_dict() for entry in entries])  # Convert entries to a dictionary format
 
+@app.route("/get_reviews/<content_type>/<content_id>", methods=["GET"])
+@login_required
+def get_reviews(content_type, content_id):
+    """Get the next page of reviews for a specific content item."""
+    before = request.args.get("before", type=int)
+    reviews, next_reviews = get_reviews_by_content_id(content_type, content_id, before)
+
+    return jsonify({"reviews": [review.to_dict() for review in reviews], "next": next_reviews})
+
 @app.route("/add_journal_entry", methods=["POST"])
 @login_required
 def add_journal_entry():
@@ -600,6 +673,18 @@ def not_found(error):
                             random_user=random_user,
                             error_msg=error), 404
 
+@app.errorhandler(SpotifyError)
+def spotify_error(error):
+    """Error page content when Spotify fails and no cached data can stand in."""
+    current_user_id = current_user.get_id()
+
+    random_user = get_random_user(current_user_id)
+
+    return render_template("error.html",
+                            current_user_id=current_user_id,
+                            random_user=random_user,
+                            error_msg="Spotify is unavailable right now. Please try again shortly."), 503
+
 @app.route("/edit_journal_entry", methods=["GET", "POST"])
 @login_required
 def edit_journal_entry():
@@ -0,0 +1,14 @@
+"""
+conftest.py
+
+Test setup, run before any test module imports the app: a scratch database
+and dummy Spotify credentials.
+"""
+
+import os
+import tempfile
+
+os.environ["REVERB_DATABASE_URI"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "reverb.db")
+os.environ.setdefault("CLIENT_ID", "test")
+os.environ.setdefault("CLIENT_SECRET", "test")
+os.environ.setdefault("SECRET_KEY", "test")
@@ -0,0 +1,35 @@
+"""
+test_content_pool.py
+
+Checks that sampling random content never waits on Spotify, and that each
+content type of the pool is refreshed on its own.
+"""
+
+from utils import spotify
+from utils.models import ContentItem
+from utils.spotify import ContentPool, SpotifyError
+
+def test_sample_cold_pool_returns_nothing(monkeypatch):
+    """An empty pool answers right away instead of searching Spotify"""
+    def search(*args, **kwargs):
+        raise AssertionError("sample must not call Spotify")
+
+    monkeypatch.setattr(spotify, "spotify_search_item", search)
+
+    assert not ContentPool().sample("track", 5)
+
+def test_refresh_types_independently(monkeypatch):
+    """A failing refresh of one type leaves the other type's pool filled"""
+    def search(name, content_type, number=10):
+        if content_type == "track":
+            raise SpotifyError("Spotify returned 400 for search", 400)
+
+        return [ContentItem(f"{content_type}{i}", content_type, "Name", None) for i in range(number)]
+
+    monkeypatch.setattr(spotify, "spotify_search_item", search)
+    pool = ContentPool(searches=1, top=3)
+
+    pool.refresh_all()
+
+    assert len(pool.sample("album", 5)) == 3
+    assert not pool.sample("track", 5)
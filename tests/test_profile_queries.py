@@ -0,0 +1,165 @@
+"""
+test_profile_queries.py
+
+Checks that a profile page costs a fixed number of SQL statements, however
+many reviews, journal entries, collections and friends it shows.
+
+Run with `python -m pytest` from the repository root.
+"""
+
+import re
+import json
+import random
+
+import pytest
+from sqlalchemy import event
+
+from utils import spotify
+
+class FakeResponse:
+    """Successful response from the fake Spotify API"""
+    def __init__(self, data):
+        self.status_code = 200
+        self.headers = {}
+        self.content = json.dumps(data).encode("utf-8")
+
+def fake_item(content_id, content_type):
+    """Spotify track or album object"""
+    images = [{"url": f"https://images.test/{content_id}/{size}"} for size in (640, 300, 64)]
+    item = {"id": content_id, "name": f"Name {content_id}", "artists": [{"name": "Artist"}]}
+
+    if content_type == "track":
+        item["album"] = {"images": images}
+    else:
+        item["images"] = images
+
+    return item
+
+def fake_get(url, params=None, **kwargs):
+    """Answers the Spotify API calls Reverb makes without leaving the process"""
+    path = url[len(spotify.SPOTIFY_ENDPOINT):]
+
+    if path == "search":
+        content_type = params["type"]
+        items = [fake_item(f"{content_type}{i}", content_type) for i in range(params["limit"])]
+        return FakeResponse({content_type + "s": {"items": items}})
+
+    if params and "ids" in params:
+        return FakeResponse({path: [fake_item(i, path[:-1]) for i in params["ids"].split(",")]})
+
+    collection, content_id = path.split("/")
+    return FakeResponse(fake_item(content_id, collection[:-1]))
+
+# Never reach the real Spotify API, including from background threads
+spotify.spotify_client.session.get = fake_get
+spotify.spotify_client.session.post = lambda url, **kwargs: FakeResponse(
+    {"access_token": "token", "expires_in": 3600})
+
+# pylint: disable=wrong-import-position
+from reverb import app, PROFILE_PAGE_SIZE
+from utils.database import db, create_user, post_review, post_journal_entry,\
+    create_collection, create_friendship, accept_friendship, get_profile_reviews
+from utils.models import Users, Friendships
+
+PASSWORD = "Passw0rd!!test"
+
+# Statements for a warm profile page viewed by its owner: the logged in user,
+# a random user (the largest id, then one probe), the profile's user and
+# counters, and one per list (reviews, journal entries, pending requests sent
+# and received, collections, friends)
+OWNER_PROFILE_STATEMENTS = 10
+
+def add_user(username, items):
+    """User with items reviews, journal entries, collections and friends"""
+    user_id = create_user(username, PASSWORD)
+
+    for i in range(items):
+        content_type = "track" if i % 2 else "album"
+        post_review(user_id, content_type, f"{username}{content_type}{i}", i % 6, "Review")
+        post_journal_entry(user_id, f"{username}journal{i}", "Entry", "track")
+        create_collection(user_id, f"{username} collection {i}", "", None)
+
+        friend_id = create_user(f"{username}friend{i}", PASSWORD)
+        create_friendship(user_id, friend_id)
+        friendship = Friendships.query.filter_by(user_id1=user_id, user_id2=friend_id).first()
+        accept_friendship(friendship.id)
+
+    return user_id
+
+@pytest.fixture(scope="module")
+def profiles():
+    """Ids of a profile with one item per tab and one with more than a page"""
+    app.config["WTF_CSRF_ENABLED"] = False
+
+    with app.app_context():
+        small = add_user("small", 1)
+        large = add_user("large", PROFILE_PAGE_SIZE + 5)
+
+        # The random user probe always lands on the last user, never the viewer
+        create_user("last", PASSWORD)
+
+    return small, large
+
+def owner_client(user_id):
+    """Test client logged in as the user"""
+    client = app.test_client()
+
+    with app.app_context():
+        username = db.session.get(Users, user_id).username
+
+    client.post("/login", data={"username": username, "password": PASSWORD})
+    return client
+
+def count_statements(client, url):
+    """Number of SQL statements run while serving url"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        response = client.get(url)
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+    assert response.status_code == 200
+    return len(statements)
+
+def test_profile_statements_do_not_grow_with_items(profiles, monkeypatch):
+    """Owner's profile runs the same fixed set of statements, small or large"""
+    monkeypatch.setattr(random, "randint", lambda low, high: high)
+
+    counts = []
+
+    for user_id in profiles:
+        client = owner_client(user_id)
+        url = f"/user/{user_id}"
+
+        # Warm up the metadata cache and catalog first
+        client.get(url)
+        counts.append(count_statements(client, url))
+
+    assert counts == [OWNER_PROFILE_STATEMENTS, OWNER_PROFILE_STATEMENTS]
+
+def review_position(review):
+    """Order in which add_user posted the review, from its content id"""
+    return int(re.search(r"\d+$", review.content_id).group())
+
+def test_profile_reviews_stay_newest_first(profiles):
+    """Pages of reviews keep the newest first order across content types"""
+    _, large = profiles
+    positions = []
+
+    with app.test_request_context():
+        reviews, next_before = get_profile_reviews(large, limit=PROFILE_PAGE_SIZE)
+        positions += [review_position(review) for review in reviews]
+
+        reviews, _ = get_profile_reviews(large, next_before, PROFILE_PAGE_SIZE)
+        positions += [review_position(review) for review in reviews]
+
+    assert positions == sorted(positions, reverse=True)
+    assert len(positions) == PROFILE_PAGE_SIZE + 5
@@ -0,0 +1,286 @@
+"""
+test_spotify_client.py
+
+Checks that the Spotify client's circuit breaker never stays half-open when
+its trial call ends without reaching Spotify, and that calls stay within the
+page's latency budget.
+"""
+
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+from requests import Timeout, ConnectionError as RequestsConnectionError
+
+from utils import spotify
+from utils.ratelimit import CircuitBreaker
+from utils.models import ContentItem
+from utils.spotify import SpotifyClient, SpotifyUnavailable, SpotifyTimeout, latency_budget,\
+    remaining_budget, MetadataBatcher
+
+class FakeResponse:
+    """Successful response from the fake Spotify API"""
+    def __init__(self, data):
+        self.status_code = 200
+        self.headers = {}
+        self.content = json.dumps(data).encode("utf-8")
+
+@pytest.fixture
+def client(monkeypatch):
+    """Client whose breaker is open and lets a trial call through right away"""
+    monkeypatch.setattr(spotify, "get_token", lambda: "token")
+
+    client = SpotifyClient(max_attempts=1, max_wait=0)
+    client.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    client.breaker.record_failure()
+    client.session.get = lambda url, **kwargs: FakeResponse({"ok": True})
+
+    return client
+
+def test_release_reopens_half_open_breaker():
+    """A released trial call leaves room for another one"""
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    breaker.release()
+
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.allow()
+
+def test_release_leaves_closed_breaker_closed():
+    """Calls ending without an outcome while closed change nothing"""
+    breaker = CircuitBreaker()
+    breaker.release()
+
+    assert breaker.state == CircuitBreaker.CLOSED
+
+def test_trial_call_refused_by_quota(client):
+    """A trial call without a free token does not block later calls"""
+    client.bucket.pause(60)
+
+    with pytest.raises(SpotifyUnavailable, match="quota"):
+        client.get("tracks/1")
+
+    client.bucket = spotify.TokenBucket(10, 10)
+
+    assert client.get("tracks/1") == {"ok": True}
+    assert client.breaker.state == CircuitBreaker.CLOSED
+
+def test_trial_call_out_of_budget(client):
+    """A trial call cut short by the page's latency budget does not block later calls"""
+    def slow_get(url, timeout=None, **kwargs):
+        time.sleep(timeout[1])
+        raise Timeout("read timed out")
+
+    client.session.get = slow_get
+
+    with pytest.raises(SpotifyTimeout):
+        latency_budget(0.05)(client.get)("tracks/1")
+
+    client.session.get = lambda url, **kwargs: FakeResponse({"ok": True})
+
+    assert client.get("tracks/2") == {"ok": True}
+    assert client.breaker.state == CircuitBreaker.CLOSED
+
+def test_trial_call_failing_unexpectedly(client):
+    """A trial call raising something other than a request error does not block later calls"""
+    def broken_get(url, **kwargs):
+        raise ValueError("unexpected")
+
+    client.session.get = broken_get
+
+    with pytest.raises(ValueError):
+        client.get("tracks/1")
+
+    client.session.get = lambda url, **kwargs: FakeResponse({"ok": True})
+
+    assert client.get("tracks/2") == {"ok": True}
+    assert client.breaker.state == CircuitBreaker.CLOSED
+
+def test_budget_error_is_not_a_breaker_failure(client):
+    """Running out of budget does not count against Spotify, whatever the error type"""
+    client.breaker = CircuitBreaker(failure_threshold=1)
+
+    def slow_get(url, timeout=None, **kwargs):
+        time.sleep(timeout[1])
+        raise RequestsConnectionError("max retries exceeded")
+
+    client.session.get = slow_get
+
+    with pytest.raises(SpotifyTimeout):
+        latency_budget(0.05)(client.get)("tracks/1")
+
+    assert client.breaker.state == CircuitBreaker.CLOSED
+
+class SlowHandler(BaseHTTPRequestHandler):
+    """Answers every request after a delay, counting the requests"""
+    delay = 0.5
+    requests = 0
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Slow JSON response"""
+        SlowHandler.requests += 1
+        time.sleep(self.delay)
+
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(b"{}")
+        except OSError:
+            # The client gave up already
+            pass
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+@pytest.fixture
+def slow_server():
+    """Endpoint of a local server slower than the budgets used below"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    server.daemon_threads = True
+    SlowHandler.requests = 0
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1/"
+
+    server.shutdown()
+    server.server_close()
+
+def test_read_timeouts_stay_within_budget(slow_server, monkeypatch):
+    """A slow Spotify costs one request and no more than the page's budget"""
+    monkeypatch.setattr(spotify, "get_token", lambda: "token")
+    client = SpotifyClient(endpoint=slow_server)
+
+    start = time.monotonic()
+
+    with pytest.raises(SpotifyTimeout):
+        latency_budget(0.2)(client.get)("tracks/1")
+
+    assert time.monotonic() - start < 0.4
+    assert SlowHandler.requests == 1
+    assert client.breaker.state == CircuitBreaker.CLOSED
+
+def run_with_budgets(budgets, fn, *args):
+    """Run fn(*args) in one thread per budget, started in order; returns results or errors"""
+    outcomes = [None] * len(budgets)
+
+    def run(i, budget):
+        try:
+            outcomes[i] = latency_budget(budget)(fn)(*args)
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            outcomes[i] = ex
+
+    threads = [threading.Thread(target=run, args=(i, budget)) for i, budget in enumerate(budgets)]
+
+    for thread in threads:
+        thread.start()
+        time.sleep(0.02)
+
+    for thread in threads:
+        thread.join()
+
+    return outcomes
+
+def test_shared_call_follower_keeps_its_own_budget(client):
+    """A caller joining a call whose leader runs out of budget still gets an answer"""
+    client.breaker = CircuitBreaker()
+
+    def slow_get(url, timeout=None, **kwargs):
+        # Spotify needs 0.3 s to answer
+        if timeout[1] < 0.3:
+            time.sleep(timeout[1])
+            raise Timeout("read timed out")
+
+        time.sleep(0.3)
+        return FakeResponse({"ok": True})
+
+    client.session.get = slow_get
+
+    leader, follower = run_with_budgets([0.1, 5], client.get, "tracks/1")
+
+    assert isinstance(leader, SpotifyTimeout)
+    assert follower == {"ok": True}
+
+def test_batch_follower_keeps_its_own_budget(monkeypatch):
+    """A lookup merged into a batch sent under a nearly spent budget still gets its item"""
+    def fetch_several_ids(content_type, content_ids):
+        # Spotify needs 0.3 s to answer
+        budget = remaining_budget()
+        if budget is not None and budget < 0.3:
+            time.sleep(max(budget, 0))
+            raise SpotifyTimeout("Latency budget ran out waiting for Spotify")
+
+        time.sleep(0.3)
+        return {content_id: ContentItem(content_id, content_type, "Name", None)
+                for content_id in content_ids}
+
+    monkeypatch.setattr(spotify, "fetch_several_ids", fetch_several_ids)
+    batcher = MetadataBatcher(window=0.05)
+
+    leader, follower = run_with_budgets([0.1, 5], batcher.load, "track", "1")
+
+    assert isinstance(leader, SpotifyTimeout)
+    assert follower.content_id == "1"
+
+def test_token_wait_stays_within_budget(monkeypatch):
+    """Waiting on another thread's token refresh gives up when the budget runs out"""
+    manager = spotify.TokenManager()
+    monkeypatch.setattr(spotify, "request_token", lambda: ("token", 3600))
+
+    manager._lock.acquire()  # pylint: disable=protected-access
+    try:
+        start = time.monotonic()
+
+        with pytest.raises(SpotifyTimeout):
+            latency_budget(0.1)(manager.get)()
+
+        assert time.monotonic() - start < 0.3
+    finally:
+        manager._lock.release()  # pylint: disable=protected-access
+
+    assert latency_budget(0.1)(manager.get)() == "token"
+
+@pytest.mark.skipif(spotify.fcntl is None, reason="needs fcntl")
+def test_shared_token_file_wait_stays_within_budget(monkeypatch, tmp_path):
+    """Waiting on another process's token refresh gives up when the budget runs out"""
+    cache_path = str(tmp_path / "token.json")
+    manager = spotify.TokenManager(cache_path)
+    monkeypatch.setattr(spotify, "request_token", lambda: ("token", 3600))
+
+    with open(cache_path + ".lock", "a", encoding="utf-8") as other_process:
+        spotify.fcntl.flock(other_process, spotify.fcntl.LOCK_EX)
+        start = time.monotonic()
+
+        with pytest.raises(SpotifyTimeout):
+            latency_budget(0.1)(manager.get)()
+
+        assert time.monotonic() - start < 0.3
+        spotify.fcntl.flock(other_process, spotify.fcntl.LOCK_UN)
+
+    assert latency_budget(0.1)(manager.get)() == "token"
+
+def test_token_post_goes_through_breaker():
+    """Token requests count toward and are refused by the circuit breaker"""
+    client = SpotifyClient()
+    client.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+
+    def failing_post(url, **kwargs):
+        raise RequestsConnectionError("connection refused")
+
+    client.session.post = failing_post
+
+    with pytest.raises(SpotifyUnavailable, match="failed"):
+        client.post("https://accounts.test/api/token")
+
+    assert client.breaker.state == CircuitBreaker.OPEN
+
+    with pytest.raises(SpotifyUnavailable, match="circuit breaker"):
+        client.post("https://accounts.test/api/token")
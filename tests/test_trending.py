@@ -0,0 +1,41 @@
+"""
+test_trending.py
+
+Checks that trend scores, kept as log2 of summed weights, match plain sums
+and never overflow however far reviews are from the trend epoch.
+"""
+
+import math
+
+import pytest
+
+from utils.database import add_log2, trend_exponent, TREND_EPOCH, TREND_HALF_LIFE
+
+def test_add_log2_matches_plain_sums():
+    """Adding and removing weights in log space agrees with doing it directly"""
+    total = -math.inf
+
+    for exponent in [0, 1, 2.5, -3]:
+        total = add_log2(total, exponent)
+
+    assert 2 ** total == pytest.approx(1 + 2 + 2 ** 2.5 + 2 ** -3)
+
+    total = add_log2(total, 1, -1)
+
+    assert 2 ** total == pytest.approx(1 + 2 ** 2.5 + 2 ** -3)
+
+def test_removing_everything_leaves_an_empty_score():
+    """Removing the only weight gives -inf, the score of content without reviews"""
+    assert add_log2(add_log2(None, 5), 5, -1) == -math.inf
+    assert add_log2(-math.inf, 5, -1) == -math.inf
+
+def test_far_future_reviews_do_not_overflow():
+    """Reviews thousands of half-lives after the epoch still combine and rank"""
+    far = trend_exponent(TREND_EPOCH + 5000 * TREND_HALF_LIFE)
+    newer = trend_exponent(TREND_EPOCH + 5001 * TREND_HALF_LIFE)
+
+    two_far = add_log2(add_log2(None, far), far)
+
+    assert math.isfinite(two_far)
+    assert two_far == pytest.approx(far + 1)
+    assert add_log2(None, newer) == pytest.approx(two_far)
@@ -0,0 +1,101 @@
+"""
+cache.py
+
+Small thread-safe in-process caches.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+class LRUCache:
+    """Least recently used cache with a size cap and a time to live for entries."""
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None, allow_stale=False):
+        """
+        Returns the cached value for key, or default if missing or expired.
+        Expired entries stay until evicted, and allow_stale still returns them.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is None:
+                return default
+
+            value, expires_at = entry
+
+            if not allow_stale and expires_at is not None and time.time() >= expires_at:
+                return default
+
+            self._data.move_to_end(key)
+
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Caches value for key, evicting the least recently used entries if full."""
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """Removes key from the cache if present."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Removes every entry."""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one call. Callers arriving
+    while it is in flight wait for it and receive the same result or error.
+    """
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, timeout=None):
+        """
+        Calls fn(*args) unless a call with the same key is in flight. Callers
+        waiting on another call give up after timeout seconds (TimeoutError).
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = Future()
+                self._calls[key] = call
+
+        if not leader:
+            return call.result(timeout=timeout)
+
+        try:
+            result = fn(*args)
+        except BaseException as ex:
+            call.set_exception(ex)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+        call.set_result(result)
+
+        return result
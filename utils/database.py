@@ -6,16 +6,30 @@ Backend utilities for managing the database.
 
 #!/usr/bin/env python
 
+import os
+import json
+import math
+import re
+import sys
+import time
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import url_for
+from flask import url_for, has_app_context, current_app, g
 
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import and_, or_, func
-from utils.models import Base, ContentItem
-from utils.models import Users, Reviews, Friendships, JournalEntry
+from sqlalchemy import and_, or_, case, func, inspect, text, event
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError, OperationalError
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from utils.models import Base, ContentItem, TextSearchResult, ReviewContent,\
+    JournalEntryContent, ProfileView
+from utils.models import Users, UserStats, Reviews, ContentStats, Friendships, JournalEntry
 from utils.models import Collections, Content, CollectionsContent
-from utils.spotify import get_content_several_ids, get_content_image
+from utils.prefix import PrefixIndex
+from utils.spotify import get_content_several_ids, get_content_image, get_content_info,\
+    metadata_cache, placeholder_content, fetch_many_ids, SpotifyError
 
 # To-do: error handling e.g. null or repeat values
 
@@ -28,7 +42,335 @@ def db_init(app):
 
     # Creates the logs, tables if the db doesnt already exist
     with app.app_context():
+        event.listen(db.engine, "connect", register_sql_functions)
         db.create_all()
+        migrate_schema()
+
+        if REVERB_SEARCH_BACKEND == "memory":
+            load_name_indexes()
+
+    # Back the in-process Spotify metadata cache with the local catalog
+    metadata_cache.store = CatalogStore()
+
+def migrate_schema():
+    """
+    Bring a database created by an older version up to date: add new nullable
+    columns, link existing reviews and journal entries to the catalog, create
+    missing indexes (removing duplicates that break uniqueness first) and the
+    full-text search indexes.
+    """
+    inspector = inspect(db.engine)
+
+    with db.engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=db.engine.dialect)
+                    connection.execute(text(
+                        f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+        # Metadata used to be cached in its own table, now the catalog holds it
+        connection.execute(text("DROP TABLE IF EXISTS content_metadata"))
+
+        # Trend scores used to be stored as plain sums of weights, which overflow;
+        # the aggregates are derived data, so they are rebuilt below
+        if "trend_score" in {column["name"] for column in inspector.get_columns("content_stats")}:
+            ContentStats.__table__.drop(bind=connection)
+            ContentStats.__table__.create(bind=connection)
+
+        for table in ["reviews", "journal_entries"]:
+            connection.execute(text(f"""
+                INSERT INTO content (spotify_id, spotify_type)
+                SELECT content_id, MIN(content_type) FROM {table}
+                WHERE catalog_id IS NULL
+                AND content_id NOT IN (SELECT spotify_id FROM content)
+                GROUP BY content_id
+            """))
+            connection.execute(text(f"""
+                UPDATE {table} SET catalog_id =
+                    (SELECT id FROM content WHERE content.spotify_id = {table}.content_id)
+                WHERE catalog_id IS NULL
+            """))
+
+        # Before their unique indexes exist, keep only the latest review/journal
+        # entry per user and content
+        for table, index_name, key in [
+            ("reviews", "ix_reviews_user_content", "user_id, content_id, content_type"),
+            ("journal_entries", "ix_journal_entries_user_content", "user_id, content_id")
+        ]:
+            if index_name not in {index["name"] for index in inspector.get_indexes(table)}:
+                remove_duplicates(connection, table, key)
+
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=connection, checkfirst=True)
+
+    # Users created before user_stats existed get their counters computed once
+    rebuild_user_stats(only_missing=True)
+
+    if not db.session.query(ContentStats).first() and db.session.query(Reviews).first():
+        rebuild_content_stats()
+
+    create_search_indexes()
+
+def remove_duplicates(connection, table, key):
+    """
+    Delete all but the latest row of table per key columns, printing every
+    removed row to stderr so it can be restored by hand.
+    """
+    duplicates = f"id NOT IN (SELECT MAX(id) FROM {table} GROUP BY {key})"
+    rows = connection.execute(text(f"SELECT * FROM {table} WHERE {duplicates}")).mappings().all()
+
+    if not rows:
+        return
+
+    print(f"Removing {len(rows)} duplicate rows from {table}:", file=sys.stderr)
+    for row in rows:
+        print(json.dumps(dict(row)), file=sys.stderr)
+
+    connection.execute(text(f"DELETE FROM {table} WHERE {duplicates}"))
+
+### CATALOG ###
+# Seconds before catalog metadata is refreshed from Spotify in the background
+CATALOG_TTL = int(os.getenv("CATALOG_TTL", str(30 * 24 * 60 * 60)))
+
+# Random primary keys tried before falling back to the next row after one
+RANDOM_PROBES = 3
+
+class CatalogRefresher:
+    """Refreshes stale catalog metadata from Spotify on a background thread."""
+    def __init__(self):
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="catalog-refresh")
+
+    def schedule(self, keys):
+        """Queue (content type, content id) keys for a refresh unless already queued."""
+        with self._lock:
+            keys = [key for key in keys if key not in self._pending]
+            self._pending.update(keys)
+
+        if keys:
+            self._executor.submit(self._refresh, current_app._get_current_object(), keys)
+
+    def _refresh(self, app, keys):
+        ids_by_type = {}
+        for content_type, content_id in keys:
+            ids_by_type.setdefault(content_type, []).append(content_id)
+
+        try:
+            with app.app_context():
+                items = fetch_many_ids(ids_by_type)
+                metadata_cache.put_many(list(items.values()))
+        except Exception as ex:
+            print(f"Catalog refresh failed: {ex!r}", file=sys.stderr)
+        finally:
+            with self._lock:
+                self._pending.difference_update(keys)
+
+catalog_refresher = CatalogRefresher()
+
+class CatalogStore:
+    """
+    Persistent tier of the Spotify metadata cache, backed by the content table.
+    Survives restarts and is shared between worker processes through the database.
+    Uses its own session so caching never commits the request's pending changes.
+    """
+    def __init__(self, ttl=CATALOG_TTL):
+        self.ttl = ttl
+
+    def get_many(self, keys, allow_stale=False):
+        """
+        Get stored ContentItems for (content type, content id) keys, as a dict by key.
+        Stale entries are still returned, and refreshed in the background.
+        """
+        if not keys or not has_app_context():
+            return {}
+
+        found = {}
+        stale = []
+        min_fetched_at = time.time() - self.ttl
+
+        try:
+            with Session(db.engine) as session:
+                rows = session.query(Content).filter(
+                    Content.spotify_id.in_({content_id for _, content_id in keys}),
+                    Content.fetched_at.is_not(None)
+                ).all()
+
+                for row in rows:
+                    key = (row.spotify_type, row.spotify_id)
+                    found[key] = row.to_content_item()
+
+                    if row.fetched_at < min_fetched_at:
+                        stale.append(key)
+        except SQLAlchemyError:
+            # The cache is best effort, fall back to Spotify
+            return {}
+
+        if stale and not allow_stale:
+            catalog_refresher.schedule(stale)
+
+        return found
+
+    def put_many(self, items):
+        """Store ContentItems fetched from Spotify in the catalog"""
+        if not items or not has_app_context():
+            return
+
+        now = time.time()
+
+        try:
+            with Session(db.engine) as session:
+                rows = session.query(Content).filter(
+                    Content.spotify_id.in_([item.content_id for item in items])).all()
+                rows_by_id = {row.spotify_id: row for row in rows}
+
+                for item in items:
+                    row = rows_by_id.get(item.content_id)
+
+                    if row is None:
+                        row = Content(spotify_id=item.content_id, spotify_type=item.content_type)
+                        session.add(row)
+                        rows_by_id[item.content_id] = row
+
+                    row.set_metadata(item, now)
+
+                session.commit()
+        except SQLAlchemyError:
+            # e.g. another process inserted the same row first
+            pass
+
+def get_catalog_items(entries):
+    """
+    ContentItems for (content type, content id, catalog row or None) entries, as a
+    dict by (content type, content id). Metadata stored in the catalog is used as is
+    (stale rows are refreshed in the background); only content that was never
+    fetched is requested from Spotify.
+    """
+    found = {}
+    missing = { "tracks": [], "albums": [] }
+    stale = []
+    min_fetched_at = time.time() - CATALOG_TTL
+
+    for content_type, content_id, row in entries:
+        item = row.to_content_item() if row is not None else None
+
+        if item is None:
+            missing[content_type + "s"].append(content_id)
+            continue
+
+        found[(content_type, content_id)] = item
+
+        if row.fetched_at < min_fetched_at:
+            stale.append((content_type, content_id))
+
+    if missing["tracks"] or missing["albums"]:
+        for c in get_content_several_ids(missing):
+            found[(c.content_type, c.content_id)] = c
+
+    if stale:
+        catalog_refresher.schedule(stale)
+
+    return found
+
+class ContentLoader:
+    """
+    Request-scoped batch loader for content metadata. Code registers the
+    (content type, content id) keys it needs, with their catalog rows when
+    already loaded. The first access resolves everything pending in one
+    deduplicated get_catalog_items call, so a page fetches each content type
+    from Spotify at most once.
+    """
+    def __init__(self):
+        self._pending = {}
+        self._resolved = set()
+        self._items = {}
+
+    def want(self, content_type, content_id, catalog=None):
+        """Registers a key to resolve on the next load, with its catalog row if known."""
+        key = (content_type, content_id)
+
+        if key not in self._resolved and self._pending.get(key) is None:
+            self._pending[key] = catalog
+
+    def load(self):
+        """Resolves pending keys. Returns ContentItems by key, without unavailable content."""
+        if self._pending:
+            pending, self._pending = self._pending, {}
+
+            self._items.update(get_catalog_items([(content_type, content_id, catalog)
+                                                  for (content_type, content_id), catalog
+                                                  in pending.items()]))
+            self._resolved.update(pending)
+
+        return self._items
+
+    def load_many(self, keys):
+        """Registers keys and resolves them along with anything else pending."""
+        for content_type, content_id in keys:
+            self.want(content_type, content_id)
+
+        return self.load()
+
+def content_loader():
+    """The current request's ContentLoader, or a new one outside of a request"""
+    if not has_app_context():
+        return ContentLoader()
+
+    if "content_loader" not in g:
+        g.content_loader = ContentLoader()
+
+    return g.content_loader
+
+def get_or_create_content(spotify_id, spotify_type):
+    """Get the catalog row for content, creating it (with metadata if known) if needed"""
+    content = db.session.query(Content).filter(Content.spotify_id == spotify_id).first()
+    if content:
+        return content
+
+    content = Content(spotify_id=spotify_id, spotify_type=spotify_type)
+
+    # Usually a cache hit, since the content page was just shown
+    try:
+        content_item = get_content_info(spotify_type, spotify_id)
+    except SpotifyError:
+        content_item = None
+
+    if content_item:
+        content.set_metadata(content_item, time.time())
+
+    db.session.add(content)
+
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another request (or the metadata cache) created the row first
+        db.session.rollback()
+        content = db.session.query(Content).filter(Content.spotify_id == spotify_id).first()
+
+    return content
+
+### PAGINATION ###
+def keyset_page(query, id_column, before=None, limit=None):
+    """
+    Rows of query newest first by id_column, starting below the before cursor
+    if given. Returns at most limit rows (all without a limit) and whether
+    more rows follow.
+    """
+    if before is not None:
+        query = query.filter(id_column < before)
+
+    query = query.order_by(id_column.desc())
+
+    if limit is None:
+        return query.all(), False
+
+    rows = query.limit(limit + 1).all()
+
+    return rows[:limit], len(rows) > limit
 
 ### USERS ###
 def create_user(username, password):
@@ -37,8 +379,13 @@ def create_user(username, password):
     new_user.set_password(password)
 
     db.session.add(new_user)
+    db.session.flush()
+    db.session.add(UserStats(user_id=new_user.id))
     db.session.commit()
 
+    if REVERB_SEARCH_BACKEND == "memory":
+        user_name_index.add(new_user.id, new_user.username)
+
     return new_user.id
 
 def update_profile(user_id, bio, favorite_genre):
@@ -50,7 +397,13 @@ def update_profile(user_id, bio, favorite_genre):
 
 def get_user_by_id(user_id):
     """Get user information using user id"""
-    user = db.session.query(Users).filter(Users.id == user_id).first()
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+
+    # Served from the session without a query if already loaded, e.g. by the login manager
+    user = db.session.get(Users, user_id)
 
     return user if user else None
 
@@ -84,6 +437,8 @@ def accept_friendship(request_id):
     friend_request = Friendships.query.get(request_id)
     if friend_request and friend_request.status == 'pending':
         friend_request.status = 'accepted'
+        update_user_stats(friend_request.user_id1, friend_count=1)
+        update_user_stats(friend_request.user_id2, friend_count=1)
         db.session.commit()
 
 def reject_friendship(request_id):
@@ -97,69 +452,303 @@ def remove_friendship(request_id):
     """Deletes friendship connection"""
     friendship = Friendships.query.get(request_id)
     if friendship and (friendship.status == 'accepted' or friendship.status == 'pending'):
+        if friendship.status == 'accepted':
+            update_user_stats(friendship.user_id1, friend_count=-1)
+            update_user_stats(friendship.user_id2, friend_count=-1)
+
         db.session.delete(friendship)
         db.session.commit()
 
-def get_friends(user_id):
-    """Fetching all friendships where the user is either user_id1 or user_id2"""
-    friendships = Friendships.query.filter(
-        or_(Friendships.user_id1 == user_id, Friendships.user_id2 == user_id),
-        Friendships.status.in_(['accepted', 'pending'])
-    ).all()
+def get_friends(user_id, before=None, limit=None):
+    """
+    Fetching accepted friendships where the user is either user_id1 or user_id2,
+    newest first, optionally one page of limit below the before friendship id.
+    Returns (other user, friendship id) pairs and the cursor for the next page,
+    or None on the last page.
+    """
+    query = friendships_with_other_user(user_id).filter(Friendships.status == 'accepted')
+
+    rows, more = keyset_page(query, Friendships.id, before, limit)
+    next_before = rows[-1][0].id if more else None
+
+    return [(other_user, friendship.id) for friendship, other_user in rows], next_before
+
+def get_pending_friends(user_id, sent, before=None, limit=None):
+    """
+    Fetching the user's pending friend requests, the ones sent or the ones
+    received, newest first, optionally one page of limit below the before
+    friendship id. Returns (other user, friendship id) pairs and the cursor for
+    the next page, or None on the last page.
+    """
+    requester = Friendships.user_id1 if sent else Friendships.user_id2
+    query = friendships_with_other_user(user_id).filter(
+        requester == user_id,
+        Friendships.status == 'pending'
+    )
+
+    rows, more = keyset_page(query, Friendships.id, before, limit)
+    next_before = rows[-1][0].id if more else None
+
+    return [(other_user, friendship.id) for friendship, other_user in rows], next_before
+
+def friendships_with_other_user(user_id):
+    """Query for the user's friendships, each joined to the other user in one query"""
+    other_user_id = case((Friendships.user_id1 == user_id, Friendships.user_id2),
+                         else_=Friendships.user_id1)
+
+    return db.session.query(Friendships, Users).join(
+        Users, Users.id == other_user_id
+    ).filter(
+        or_(Friendships.user_id1 == user_id, Friendships.user_id2 == user_id)
+    )
 
-    # Separate lists for friends and pending requests (both sent and received)
-    friends = []
-    pending_requests_sent = []
-    pending_requests_received = []
-
-    for friendship in friendships:
-        is_pending = friendship.status == 'pending'
-        is_requester = friendship.user_id1 == user_id
-        other_user_id = friendship.user_id2 if is_requester else friendship.user_id1
-        other_user = Users.query.get(other_user_id)
-
-        if is_pending:
-            if is_requester:
-                pending_requests_sent.append((other_user, friendship.id))
-            else:
-                pending_requests_received.append((other_user, friendship.id))
-        else:
-            friends.append((other_user, friendship.id))
+### SEARCH ###
+# Most users, and most collections, returned for one search
+REVERB_SEARCH_LIMIT = int(os.getenv("REVERB_SEARCH_LIMIT", "20"))
 
-    return friends, pending_requests_sent, pending_requests_received
+# Full-text indexes by name, with the table and column each one covers
+SEARCH_INDEXES = {
+    "users_fts": ("users", "username"),
+    "collections_fts": ("collections", "name"),
+    "reviews_fts": ("reviews", "text"),
+    "journal_entries_fts": ("journal_entries", "text")
+}
+
+# Reviews and journal entries per page of text search results
+TEXT_SEARCH_PAGE_SIZE = int(os.getenv("TEXT_SEARCH_PAGE_SIZE", "10"))
+
+# Set once create_search_indexes has run, unless SQLite lacks FTS5
+search_index_available = False
+
+# Where user and collection searches run: "sql" (the FTS5 indexes, or LIKE) or
+# "memory" (in-process prefix indexes, local to each server process)
+REVERB_SEARCH_BACKEND = os.getenv("REVERB_SEARCH_BACKEND", "sql")
 
-### SEARCH ###
 def get_reverb_results(query, user, collection):
-    """Get search results for Reverb content, e.g. users and collections."""
-    query = "%" + query + "%"
+    """
+    Get search results for Reverb content, e.g. users and collections, best
+    matches first and at most REVERB_SEARCH_LIMIT of each.
+    """
     results = []
 
+    # The prefix indexes only hold names, current rows are loaded by id
+    use_memory = REVERB_SEARCH_BACKEND == "memory" and search_tokens(query)
+    use_index = search_index_available and search_tokens(query)
+
     if user:
-        user_results = db.session.query(Users).filter(Users.username.like(query)).all()
+        if use_memory:
+            user_results = rows_in_order(Users, user_name_index.search(query,
+                                                                       REVERB_SEARCH_LIMIT))
+        elif use_index:
+            user_results = rows_in_order(Users, search_ids("users_fts", query,
+                                                           REVERB_SEARCH_LIMIT))
+        else:
+            user_results = like_search(Users.username, query, REVERB_SEARCH_LIMIT)
 
-        for row in user_results:
-            # Placeholder
-            placeholder = "/static/assets/app/user.png"
-            content_item = ContentItem(content_id=row.id,
-                                    content_type="user",
-                                    name=row.username,
-                                    image=placeholder)
-            results.append(content_item)
+        results += [user_item(row) for row in user_results]
 
     if collection:
-        user_results = db.session.query(Collections).filter(Collections.name.like(query)).all()
+        if use_memory:
+            user_results = rows_in_order(Collections,
+                                         collection_name_index.search(query, REVERB_SEARCH_LIMIT),
+                                         joinedload(Collections.user))
+        elif use_index:
+            user_results = rows_in_order(Collections,
+                                         search_ids("collections_fts", query, REVERB_SEARCH_LIMIT),
+                                         joinedload(Collections.user))
+        else:
+            user_results = like_search(Collections.name, query, REVERB_SEARCH_LIMIT)
 
-        for row in user_results:
-            content_item = ContentItem(content_id=row.id,
-                                    content_type="collection",
-                                    name=row.name,
-                                    image=row.image,
-                                    artists=[row.user.username])
-            results.append(content_item)
+        results += [collection_item(row) for row in user_results]
 
     return results
 
+def user_item(row):
+    """ContentItem for a user search result"""
+    # Placeholder
+    placeholder = "/static/assets/app/user.png"
+
+    return ContentItem(content_id=row.id,
+                       content_type="user",
+                       name=row.username,
+                       image=placeholder)
+
+def collection_item(row):
+    """ContentItem for a collection search result"""
+    return ContentItem(content_id=row.id,
+                       content_type="collection",
+                       name=row.name,
+                       image=row.image,
+                       artists=[row.user.username])
+
+def create_search_indexes():
+    """
+    Create the FTS5 indexes in SEARCH_INDEXES and the triggers keeping them in
+    sync with their tables. Indexes are filled from their tables when first
+    created. Without FTS5 support, searches fall back to LIKE.
+    """
+    global search_index_available
+
+    try:
+        with db.engine.begin() as connection:
+            existing = {row[0] for row in connection.execute(text(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"))}
+
+            for index, (table, column) in SEARCH_INDEXES.items():
+                connection.execute(text(f"""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS {index} USING fts5(
+                        {column}, content='{table}', content_rowid='id', prefix='2 3')
+                """))
+                connection.execute(text(f"""
+                    CREATE TRIGGER IF NOT EXISTS {index}_insert AFTER INSERT ON {table} BEGIN
+                        INSERT INTO {index}(rowid, {column}) VALUES (new.id, new.{column});
+                    END
+                """))
+                connection.execute(text(f"""
+                    CREATE TRIGGER IF NOT EXISTS {index}_delete AFTER DELETE ON {table} BEGIN
+                        INSERT INTO {index}({index}, rowid, {column})
+                        VALUES ('delete', old.id, old.{column});
+                    END
+                """))
+                connection.execute(text(f"""
+                    CREATE TRIGGER IF NOT EXISTS {index}_update AFTER UPDATE OF {column} ON {table}
+                    BEGIN
+                        INSERT INTO {index}({index}, rowid, {column})
+                        VALUES ('delete', old.id, old.{column});
+                        INSERT INTO {index}(rowid, {column}) VALUES (new.id, new.{column});
+                    END
+                """))
+
+                if index not in existing:
+                    connection.execute(text(f"INSERT INTO {index}({index}) VALUES ('rebuild')"))
+
+        search_index_available = True
+    except OperationalError as ex:
+        print(f"Full-text search unavailable, falling back to LIKE: {ex}", file=sys.stderr)
+        search_index_available = False
+
+def search_tokens(query):
+    """Split a query into words the way the FTS5 unicode61 tokenizer does"""
+    return re.findall(r"[^\W_]+", query.casefold())
+
+def reverb_name_matches(query, name):
+    """Whether get_reverb_results would match name for query, without ranking"""
+    word_prefixes = search_index_available or REVERB_SEARCH_BACKEND == "memory"
+
+    if word_prefixes and search_tokens(query):
+        # Every query word must start some word of the name
+        words = search_tokens(name)
+        return all(any(word.startswith(token) for word in words)
+                   for token in search_tokens(query))
+
+    return query.casefold() in name.casefold()
+
+# Usernames and collection names for REVERB_SEARCH_BACKEND "memory"
+user_name_index = PrefixIndex(search_tokens)
+collection_name_index = PrefixIndex(search_tokens)
+
+def load_name_indexes():
+    """Fill the in-process prefix indexes from the users and collections tables"""
+    user_name_index.load(db.session.query(Users.id, Users.username).all())
+    collection_name_index.load(db.session.query(Collections.id, Collections.name).all())
+
+def match_expression(query):
+    """FTS5 query matching every word of query as a prefix"""
+    return " ".join(f'"{token}"*' for token in search_tokens(query))
+
+def search_ids(index, query, limit):
+    """Ids of the rows whose indexed text matches every word of query as a prefix, best first"""
+    rows = db.session.execute(text(f"""
+        SELECT rowid FROM {index} WHERE {index} MATCH :match
+        ORDER BY bm25({index}) LIMIT :limit
+    """), {"match": match_expression(query), "limit": limit})
+
+    return [row[0] for row in rows]
+
+def like_search(column, query, limit):
+    """Rows whose column contains query, names starting with it and shorter names first"""
+    return db.session.query(column.class_).filter(
+        column.like("%" + query + "%")
+    ).order_by(
+        column.like(query + "%").desc(), func.length(column)
+    ).limit(limit).all()
+
+def rows_in_order(model, ids, *options):
+    """Load rows of model by id, in the order of ids"""
+    rows = {row.id: row for row in
+            db.session.query(model).options(*options).filter(model.id.in_(ids)).all()}
+
+    return [rows[row_id] for row_id in ids if row_id in rows]
+
+def search_review_text(query, user_id, page=1):
+    """
+    Search the text of everyone's reviews and of user_id's own journal entries,
+    best matches first. Returns one page of TextSearchResults and whether
+    there are more pages.
+    """
+    params = {"user_id": user_id,
+              "limit": TEXT_SEARCH_PAGE_SIZE + 1,
+              "offset": (page - 1) * TEXT_SEARCH_PAGE_SIZE}
+
+    if search_index_available and search_tokens(query):
+        params["match"] = match_expression(query)
+        sql = """
+            SELECT 'review' AS kind, reviews.id AS id, bm25(reviews_fts) AS score
+            FROM reviews_fts JOIN reviews ON reviews.id = reviews_fts.rowid
+            WHERE reviews_fts MATCH :match
+            UNION ALL
+            SELECT 'journal', journal_entries.id, bm25(journal_entries_fts)
+            FROM journal_entries_fts
+            JOIN journal_entries ON journal_entries.id = journal_entries_fts.rowid
+            WHERE journal_entries_fts MATCH :match AND journal_entries.user_id = :user_id
+            ORDER BY score, kind, id LIMIT :limit OFFSET :offset
+        """
+    else:
+        # Without the index, newest matches first
+        params["pattern"] = "%" + query + "%"
+        sql = """
+            SELECT 'review' AS kind, id, 0 AS score FROM reviews WHERE text LIKE :pattern
+            UNION ALL
+            SELECT 'journal', id, 0 FROM journal_entries
+            WHERE text LIKE :pattern AND user_id = :user_id
+            ORDER BY id DESC, kind LIMIT :limit OFFSET :offset
+        """
+
+    matches = db.session.execute(text(sql), params).fetchall()
+    has_more = len(matches) > TEXT_SEARCH_PAGE_SIZE
+    matches = matches[:TEXT_SEARCH_PAGE_SIZE]
+
+    reviews = rows_in_order(Reviews, [m.id for m in matches if m.kind == "review"],
+                            joinedload(Reviews.user), joinedload(Reviews.catalog))
+    entries = rows_in_order(JournalEntry, [m.id for m in matches if m.kind == "journal"],
+                            joinedload(JournalEntry.user), joinedload(JournalEntry.catalog))
+
+    rows = {("review", r.id): r for r in reviews}
+    rows.update({("journal", e.id): e for e in entries})
+
+    content_by_key = get_row_content(rows.values())
+
+    results = []
+    for m in matches:
+        row = rows.get((m.kind, m.id))
+
+        if row is None:
+            continue
+
+        c = content_by_key.get((row.content_type, row.content_id))
+
+        if c is None:
+            c = placeholder_content(row.content_type, row.content_id)
+
+        results.append(TextSearchResult(m.kind, row.user, c.image, c.name, c.content_type,
+                                        c.content_id, getattr(row, "rating", None), row.text))
+
+    return results, has_more
+
 ### REVIEWS ###
+# Reviews per page on content pages
+REVIEWS_PAGE_SIZE = int(os.getenv("REVIEWS_PAGE_SIZE", "20"))
+
 def post_review(user_id, content_type, content_id, rating, text):
     """Post review or update review if already exists"""
     existing_review = db.session.query(Reviews).filter(
@@ -171,47 +760,80 @@ def post_review(user_id, content_type, content_id, rating, text):
     ).first()
 
     if existing_review is None:
+        catalog = get_or_create_content(content_id, content_type)
+
         review = Reviews(user_id=user_id,
                          content_type=content_type,
                          content_id=content_id,
                          rating=rating,
-                         text=text)
+                         text=text,
+                         catalog_id=catalog.id,
+                         created_at=time.time())
         db.session.add(review)
+        deltas = review_deltas(review, 1)
+        trend = review_trend(review, 1)
     else:
+        # Swap the old rating for the new one in the aggregates; the trend score
+        # stays, as the review keeps its created_at
+        deltas = review_deltas(existing_review, -1)
+        trend = None
         existing_review.content_type = content_type
         existing_review.rating = rating
         existing_review.text = text
+        for name, delta in review_deltas(existing_review, 1).items():
+            deltas[name] = deltas.get(name, 0) + delta
 
-    db.session.commit()
+    try:
+        if existing_review is None:
+            update_user_stats(user_id, review_count=1)
+
+        update_content_stats(content_type, content_id, trend=trend, **deltas)
+        db.session.commit()
+    except IntegrityError:
+        # A concurrent request created the review first, so update it instead
+        db.session.rollback()
+        post_review(user_id, content_type, content_id, rating, text)
 
-def get_reviews_by_user_id(user_id):
-    """Get reviews by user id"""
-    reviews = db.session.query(Reviews).filter(Reviews.user_id == user_id).all()
+def get_reviews_by_user_id(user_id, before=None, limit=None):
+    """
+    Get reviews by user id, newest first, with their catalog rows loaded in the
+    same query. With a limit, gets one page below the before review id. Also
+    returns the cursor for the next page, or None on the last page.
+    """
+    query = db.session.query(Reviews).options(joinedload(Reviews.catalog)).filter(
+        Reviews.user_id == user_id)
 
-    content = { "tracks": [], "albums": [] }
+    reviews, more = keyset_page(query, Reviews.id, before, limit)
+    next_before = reviews[-1].id if more else None
 
-    reviews_by_type = { "tracks": [], "albums": [] }
+    content = { "tracks": [], "albums": [] }
 
     for review in reviews:
         if review.content_type == "track":
             content["tracks"].append(review.content_id)
-            reviews_by_type["tracks"].append(review)
         else:
             content["albums"].append(review.content_id)
-            reviews_by_type["albums"].append(review)
 
-    return reviews_by_type, content
+    return reviews, content, next_before
 
-def get_reviews_by_content_id(content_type, content_id):
-    """Get reviews by content type and id"""
-    reviews = db.session.query(Reviews).filter(
+def get_reviews_by_content_id(content_type, content_id, before=None, limit=None):
+    """
+    Get one page of reviews by content type and id, newest first, with their
+    authors. Returns the reviews and the id to pass as before to get the next
+    page, or None on the last page.
+    """
+    query = db.session.query(Reviews).options(joinedload(Reviews.user)).filter(
         and_(
             Reviews.content_type == content_type,
             Reviews.content_id == content_id
         )
-    ).all()
+    )
+
+    # The content index is already ordered by id within a content
+    reviews, more = keyset_page(query, Reviews.id, before, limit or REVIEWS_PAGE_SIZE)
+    next_before = reviews[-1].id if more else None
 
-    return reviews
+    return reviews, next_before
 
 ### COLLECTIONS ###
 def create_collection(user_id, name, description, image):
@@ -219,8 +841,12 @@ def create_collection(user_id, name, description, image):
     collection = Collections(user_id=user_id, name=name, description=description, image=image)
 
     db.session.add(collection)
+    update_user_stats(user_id, collection_count=1)
     db.session.commit()
 
+    if REVERB_SEARCH_BACKEND == "memory":
+        collection_name_index.add(collection.id, collection.name)
+
     return collection.id
 
 def add_content_to_collection(collection_id, spotify_id, spotify_type):
@@ -244,20 +870,19 @@ def add_content_to_collection(collection_id, spotify_id, spotify_type):
 
 def create_content(spotify_id, spotify_type):
     """Add content row to table"""
-    check = db.session.query(Content).filter(Content.spotify_id == spotify_id).first()
-    if check:
-        return check.id
+    return get_or_create_content(spotify_id, spotify_type).id
 
-    content = Content(spotify_id=spotify_id, spotify_type=spotify_type)
-
-    db.session.add(content)
-    db.session.commit()
+def get_collections_by_user_id(user_id, before=None, limit=None):
+    """
+    Get collections by user id, newest first. With a limit, gets one page below
+    the before collection id. Also returns the cursor for the next page, or
+    None on the last page.
+    """
+    query = db.session.query(Collections).options(joinedload(Collections.user)).filter(
+        Collections.user_id == user_id)
 
-    return content.id
-
-def get_collections_by_user_id(user_id):
-    """Get collections by user id"""
-    collections = db.session.query(Collections).filter(Collections.user_id == user_id).all()
+    collections, more = keyset_page(query, Collections.id, before, limit)
+    next_before = collections[-1].id if more else None
 
     content = []
     for collection in collections:
@@ -269,7 +894,7 @@ def get_collections_by_user_id(user_id):
 
         content.append(content_item)
 
-    return content
+    return content, next_before
 
 def get_collection_content(collection_id):
     """Get collection content"""
@@ -277,18 +902,21 @@ def get_collection_content(collection_id):
         CollectionsContent, CollectionsContent.content_id == Content.id).filter(
         CollectionsContent.collection_id == collection_id).all()
 
-    content_dict = { "tracks": [], "albums": [] }
+    loader = content_loader()
 
     for c in collection_content:
-        if c.spotify_type == "track":
-            content_dict["tracks"].append(c.spotify_id)
-        elif c.spotify_type == "album":
-            content_dict["albums"].append(c.spotify_id)
+        if c.spotify_type in ["track", "album"]:
+            loader.want(c.spotify_type, c.spotify_id, c)
 
-    content = get_content_several_ids(content_dict)
+    content_by_key = loader.load()
 
     content_list = []
-    for c in content:
+    for row in collection_content:
+        # Content that could not be loaded still shows, so it can be removed
+        c = content_by_key.get((row.spotify_type, row.spotify_id))
+        if c is None:
+            c = placeholder_content(row.spotify_type, row.spotify_id)
+
         content_item = ContentItem(content_id=c.content_id,
                                     content_type=c.content_type,
                                     name=c.name,
@@ -301,7 +929,7 @@ def get_collection_content(collection_id):
 
 def get_random_collection():
     """Get random collection"""
-    collection = db.session.query(Collections).order_by(func.random()).first()
+    collection = get_random_row(Collections)
 
     return collection
 
@@ -340,7 +968,9 @@ def delete_content_from_collection(collection_id, spotify_type, spotify_id):
                 CollectionsContent.collection_id == collection_id).first()
 
             if content:
-                image = get_content_image(content.spotify_type, content.spotify_id)
+                image = content.image_large
+                if content.fetched_at is None:
+                    image = get_content_image(content.spotify_type, content.spotify_id)
 
                 db.session.query(Collections).filter(
                     Collections.id == collection_id
@@ -354,7 +984,11 @@ def delete_content_from_collection(collection_id, spotify_type, spotify_id):
 
 def delete_collection(collection_id):
     """Delete collection. Deletes rows from contentcollection and collection tables."""
+    collection_id = int(collection_id)
+
     try:
+        collection = db.session.get(Collections, collection_id)
+
         # delete rows associated with collection_id
         db.session.query(CollectionsContent).filter(
             CollectionsContent.collection_id == collection_id
@@ -365,42 +999,158 @@ def delete_collection(collection_id):
             Collections.id == collection_id
         ).delete()
 
+        if collection:
+            update_user_stats(collection.user_id, collection_count=-1)
+
         db.session.commit()
+
+        if REVERB_SEARCH_BACKEND == "memory":
+            collection_name_index.remove(collection_id)
     except Exception as e:
         # if something went wrong in deletion, rollback
         db.session.rollback()
         raise e
 
-### MOST REVIEWED CONTENT ###
-def get_most_reviewed_content(user_id=None):
-    """Get most reviewed track and album, optionally for a specific user."""
-    top_content = {"tracks": [], "albums": []}
-
-    query_filter = [Reviews.content_type == "track"]
-    if user_id:
-        query_filter.append(Reviews.user_id == user_id)
-
-    track = db.session.query(Reviews.content_id).filter(*query_filter).group_by(
-        Reviews.content_id).order_by(func.count(
-        Reviews.id).desc()).first()
-
-    track = track[0] if track else ""
-    top_content["tracks"].append(track)
-
-    query_filter = [Reviews.content_type == "album"]
-    if user_id:
-        query_filter.append(Reviews.user_id == user_id)
+### TOP CONTENT ###
+# Trending weights halve every TREND_HALF_LIFE seconds. A review's weight is
+# 2 ** trend_exponent, relative to TREND_EPOCH, so scores never need decaying in
+# place. Scores are kept as log2 of the summed weights, which stays small however
+# far from the epoch reviews are, where the weights themselves overflow floats
+TREND_HALF_LIFE = float(os.getenv("TREND_HALF_LIFE", str(7 * 24 * 60 * 60)))
+TREND_EPOCH = float(os.getenv("TREND_EPOCH", "1704067200"))
+
+if not 0 < TREND_HALF_LIFE < math.inf:
+    raise ValueError(f"TREND_HALF_LIFE must be a positive number of seconds, got {TREND_HALF_LIFE}")
+
+def trend_exponent(created_at):
+    """
+    log2 of the weight of a review posted at created_at in trend scores. Comparing
+    sums of weights ranks content the same as decaying every review to the present.
+    """
+    if created_at is None:
+        created_at = TREND_EPOCH
+
+    return (created_at - TREND_EPOCH) / TREND_HALF_LIFE
+
+def add_log2(log_total, log_value, sign=1):
+    """
+    log2(2 ** log_total + sign * 2 ** log_value) without leaving log space, so
+    nothing overflows. -inf stands for a total of 0.
+    """
+    if log_total is None or log_total == -math.inf:
+        return log_value if sign > 0 else -math.inf
+
+    if sign > 0:
+        high, low = max(log_total, log_value), min(log_total, log_value)
+        return high + math.log2(1 + 2 ** (low - high))
+
+    # Removing a weight the total holds; rounding may leave nothing
+    remaining = 1 - 2 ** (log_value - log_total) if log_value <= log_total else 0
+
+    return log_total + math.log2(remaining) if remaining > 0 else -math.inf
+
+def register_sql_functions(dbapi_connection, connection_record):
+    """Make add_log2 available to SQL on each new SQLite connection"""
+    dbapi_connection.create_function("add_log2", 3, add_log2, deterministic=True)
+
+def review_deltas(review, sign):
+    """Changes to a content's counters from adding (sign 1) or removing (sign -1) review"""
+    # The histogram has buckets for the form's ratings, 0 to 5
+    rating = min(max(int(review.rating), 0), 5)
+
+    return {"review_count": sign,
+            "rating_sum": sign * rating,
+            f"rating_{rating}": sign}
+
+def review_trend(review, sign):
+    """Change to a content's trend score from adding (sign 1) or removing (sign -1) review"""
+    return sign, trend_exponent(review.created_at)
+
+def update_content_stats(content_type, content_id, trend=None, **deltas):
+    """
+    Add deltas to a content's counters, and the (sign, exponent) trend change
+    to its trend score if any, as part of the current transaction
+    """
+    values = dict(deltas)
+    set_ = {name: getattr(ContentStats, name) + delta for name, delta in deltas.items()}
+
+    if trend is not None:
+        sign, exponent = trend
+        values["log_trend_score"] = add_log2(None, exponent, sign)
+
+        # Without reviews left the score is exactly empty, whatever rounding left over
+        remaining_reviews = ContentStats.review_count + deltas.get("review_count", 0)
+        set_["log_trend_score"] = case(
+            (remaining_reviews <= 0, -math.inf),
+            else_=func.add_log2(ContentStats.log_trend_score, exponent, sign))
+
+    statement = sqlite_insert(ContentStats).values(
+        content_type=content_type, content_id=content_id, **values
+    ).on_conflict_do_update(
+        index_elements=[ContentStats.content_type, ContentStats.content_id],
+        set_=set_
+    )
+
+    db.session.execute(statement)
+
+def rebuild_content_stats():
+    """Recompute every content's aggregates from the reviews"""
+    stats = {}
+
+    for review in db.session.query(Reviews).yield_per(1000):
+        key = (review.content_type, str(review.content_id))
+        totals = stats.setdefault(key, {"log_trend_score": -math.inf})
+
+        for name, delta in review_deltas(review, 1).items():
+            totals[name] = totals.get(name, 0) + delta
+
+        totals["log_trend_score"] = add_log2(totals["log_trend_score"],
+                                             trend_exponent(review.created_at))
+
+    db.session.query(ContentStats).delete()
+    db.session.add_all([ContentStats(content_type=content_type, content_id=content_id, **totals)
+                        for (content_type, content_id), totals in stats.items()])
+    db.session.commit()
 
-    album = db.session.query(Reviews.content_id).filter(*query_filter).group_by(
-        Reviews.content_id).order_by(func.count(
-        Reviews.id).desc()).first()
+def get_content_stats(content_type, content_id):
+    """Get review aggregates by content, or None if never reviewed"""
+    return db.session.get(ContentStats, (content_type, str(content_id)))
+
+def get_trending_ids(content_type, number=1):
+    """Ids of the content with the highest trend scores, read from the trend index"""
+    rows = db.session.query(ContentStats.content_id).filter(
+        ContentStats.content_type == content_type,
+        ContentStats.review_count > 0
+    ).order_by(ContentStats.log_trend_score.desc()).limit(number).all()
+
+    return [row[0] for row in rows]
+
+def get_top_rated_id(user_id, content_type):
+    """Id of the user's highest-rated content of a type, newest first on ties"""
+    row = db.session.query(Reviews.content_id).filter(
+        Reviews.user_id == user_id,
+        Reviews.content_type == content_type
+    ).order_by(Reviews.rating.desc(), Reviews.created_at.desc()).first()
+
+    return row[0] if row else None
+
+def get_top_content_keys(user_id=None):
+    """
+    Get (content type, content id) of the trending track and album, or of a
+    specific user's top-rated ones. Both read precomputed rows through an
+    index instead of aggregating reviews; resolve them with content_loader.
+    """
+    keys = []
+
+    for content_type in ["track", "album"]:
+        if user_id:
+            ids = [get_top_rated_id(user_id, content_type)]
+        else:
+            ids = get_trending_ids(content_type)
 
-    album = album[0] if album else ""
-    top_content["albums"].append(album)
+        keys += [(content_type, content_id) for content_id in ids if content_id]
 
-    content = get_content_several_ids(top_content)
-
-    return content
+    return keys
 
 ### JOURNAL ENTRIES ###
 def post_journal_entry(user_id, content_id, text, content_type):
@@ -414,16 +1164,29 @@ def post_journal_entry(user_id, content_id, text, content_type):
 
     if existing_entry is None:
         # No existing entry, create a new one
+        catalog = get_or_create_content(content_id, content_type)
+
         entry = JournalEntry(user_id=user_id,
                                 content_id=content_id,
                                 text=text,
-                                content_type=content_type)
+                                content_type=content_type,
+                                catalog_id=catalog.id)
         db.session.add(entry)
     else:
         # Existing entry found, update it
         existing_entry.text = text
         existing_entry.content_type = content_type  # Update this if needed
-    db.session.commit()
+
+    try:
+        if existing_entry is None:
+            update_user_stats(user_id, journal_count=1)
+
+        db.session.commit()
+    except IntegrityError:
+        # A concurrent request created the entry first, so update it instead
+        db.session.rollback()
+        return post_journal_entry(user_id, content_id, text, content_type)
+
     return "Entry added successfully"
 
 def get_journal_entries_by_user_and_content(user_id, content_id):
@@ -436,9 +1199,17 @@ def get_journal_entries_by_user_and_content(user_id, content_id):
     ).all()
     return entries
 
-def get_journal_entries_by_user(user_id):
-    """Get journal entries by user id"""
-    entries = db.session.query(JournalEntry).filter(JournalEntry.user_id == user_id).all()
+def get_journal_entries_by_user(user_id, before=None, limit=None):
+    """
+    Get journal entries by user id, newest first, with their catalog rows loaded
+    in the same query. With a limit, gets one page below the before entry id.
+    Also returns the cursor for the next page, or None on the last page.
+    """
+    query = db.session.query(JournalEntry).options(joinedload(JournalEntry.catalog)).filter(
+        JournalEntry.user_id == user_id)
+
+    entries, more = keyset_page(query, JournalEntry.id, before, limit)
+    next_before = entries[-1].id if more else None
 
     content = { "tracks": [], "albums": [] }
 
@@ -452,7 +1223,7 @@ def get_journal_entries_by_user(user_id):
             content["albums"].append(entry.content_id)
             ordered_entries.append(entry)
 
-    return ordered_entries, content
+    return ordered_entries, content, next_before
 
 def set_favorite_content(user_id, content_type, content_id):
     """Set favorite content for the specified user id and content type."""
@@ -495,6 +1266,7 @@ def delete_entry(user_id, content_id):
 
     if entry:
         db.session.delete(entry)
+        update_user_stats(user_id, journal_count=-1)
         db.session.commit()
     else:
         # Handle the case where no entry was found
@@ -511,6 +1283,9 @@ def delete_review(user_id, content_id):
 
     if review:
         db.session.delete(review)
+        update_user_stats(user_id, review_count=-1)
+        update_content_stats(review.content_type, review.content_id,
+                             trend=review_trend(review, -1), **review_deltas(review, -1))
         db.session.commit()
     else:
         # Handle the case where no entry was found
@@ -528,20 +1303,175 @@ def edit_entry(user_id, content_id, text):
     entry.text = text
     db.session.commit()
 
+### PROFILE ###
+def get_profile_view(user_id, viewer_id, limit=None):
+    """
+    Load a user's profile page as a ProfileView, with the first limit items of
+    each tab: one query for the user and counters, one per tab, and a single
+    metadata lookup for the content of reviews and journal entries together.
+    Journal entries and pending friend requests are only loaded for their owner.
+    None if no such user.
+    """
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+
+    row = db.session.query(Users, UserStats).outerjoin(
+        UserStats, UserStats.user_id == Users.id
+    ).filter(Users.id == user_id).first()
+
+    if row is None:
+        return None
+
+    user, stats = row
+    view = ProfileView(user=user, stats=stats or get_user_stats(user_id))
+
+    reviews, _, view.next_reviews = get_reviews_by_user_id(user_id, limit=limit)
+
+    journal_entries = []
+    if str(user_id) == str(viewer_id):
+        journal_entries, _, view.next_journal_entries = get_journal_entries_by_user(
+            user_id, limit=limit)
+        view.pending_friends_sent, view.next_pending_friends_sent = get_pending_friends(
+            user_id, True, limit=limit)
+        view.pending_friends_received, view.next_pending_friends_received = get_pending_friends(
+            user_id, False, limit=limit)
+
+    view.collections, view.next_collections = get_collections_by_user_id(user_id, limit=limit)
+
+    view.friends, view.next_friends = get_friends(user_id, limit=limit)
+
+    content_by_key = get_row_content(reviews + journal_entries)
+    view.reviews = review_contents(reviews, content_by_key)
+    view.journal_entries = journal_entry_contents(journal_entries, content_by_key)
+
+    return view
+
+def get_profile_reviews(user_id, before=None, limit=None):
+    """A page of a user's reviews with their content, and the cursor for the next page"""
+    reviews, _, next_reviews = get_reviews_by_user_id(user_id, before, limit)
+
+    return review_contents(reviews, get_row_content(reviews)), next_reviews
+
+def get_profile_journal_entries(user_id, before=None, limit=None):
+    """A page of a user's journal entries with their content, and the cursor for the next page"""
+    entries, _, next_entries = get_journal_entries_by_user(user_id, before, limit)
+
+    return journal_entry_contents(entries, get_row_content(entries)), next_entries
+
+def get_row_content(rows):
+    """
+    ContentItems by (content type, content id) for reviews or journal entries,
+    through the request's content loader
+    """
+    loader = content_loader()
+
+    for r in rows:
+        loader.want(r.content_type, r.content_id, r.catalog)
+
+    return loader.load()
+
+def review_contents(reviews, content_by_key):
+    """ReviewContents for reviews, from get_row_content results"""
+    reviews_content = []
+
+    for r in reviews:
+        c = content_by_key.get((r.content_type, r.content_id))
+
+        if c is None:
+            c = placeholder_content(r.content_type, r.content_id)
+
+        reviews_content.append(ReviewContent(c.image, c.name, c.artists,
+                                             c.content_type, c.content_id,
+                                             r.rating, r.text))
+
+    return reviews_content
+
+def journal_entry_contents(entries, content_by_key):
+    """JournalEntryContents for journal entries, from get_row_content results"""
+    entries_content = []
+
+    for r in entries:
+        c = content_by_key.get((r.content_type, r.content_id))
+
+        if c is None:
+            c = placeholder_content(r.content_type, r.content_id)
+
+        entries_content.append(JournalEntryContent(c.image, c.name, c.content_type,
+                                                   c.content_id, r.text))
+
+    return entries_content
+
+### USER STATS ###
+def get_user_stats(user_id):
+    """Get review, friend, collection and journal counts by user id"""
+    stats = db.session.get(UserStats, user_id)
+
+    if stats is None:
+        # Not persisted, so reading it doesn't need a write
+        stats = UserStats(user_id=user_id, review_count=0, friend_count=0,
+                          collection_count=0, journal_count=0)
+
+    return stats
+
+def update_user_stats(user_id, **deltas):
+    """
+    Add deltas to a user's counters, e.g. review_count=1, as part of the
+    current transaction. A missing stats row is recomputed from scratch.
+    """
+    updated = db.session.query(UserStats).filter(UserStats.user_id == user_id).update(
+        {getattr(UserStats, name): getattr(UserStats, name) + delta
+         for name, delta in deltas.items()},
+        synchronize_session=False
+    )
+
+    if not updated:
+        # The counts already include the change, which the queries autoflush
+        db.session.add(UserStats(user_id=user_id, **count_user_stats(user_id)))
+
+def count_user_stats(user_id):
+    """Count reviews, friends, collections and journal entries by user id in SQL"""
+    return {
+        "review_count": db.session.query(func.count(Reviews.id)).filter(
+            Reviews.user_id == user_id).scalar(),
+        "friend_count": db.session.query(func.count(Friendships.id)).filter(
+            or_(Friendships.user_id1 == user_id, Friendships.user_id2 == user_id),
+            Friendships.status == "accepted").scalar(),
+        "collection_count": db.session.query(func.count(Collections.id)).filter(
+            Collections.user_id == user_id).scalar(),
+        "journal_count": db.session.query(func.count(JournalEntry.id)).filter(
+            JournalEntry.user_id == user_id).scalar()
+    }
+
+def rebuild_user_stats(only_missing=False):
+    """Recompute every user's counters from scratch, or only for users without a stats row"""
+    with db.engine.begin() as connection:
+        if not only_missing:
+            connection.execute(text("DELETE FROM user_stats"))
+
+        connection.execute(text("""
+            INSERT INTO user_stats (user_id, review_count, friend_count,
+                                    collection_count, journal_count)
+            SELECT users.id,
+                (SELECT COUNT(*) FROM reviews WHERE reviews.user_id = users.id),
+                (SELECT COUNT(*) FROM friendships
+                    WHERE friendships.user_id1 = users.id AND friendships.status = 'accepted')
+                + (SELECT COUNT(*) FROM friendships
+                    WHERE friendships.user_id2 = users.id AND friendships.status = 'accepted'),
+                (SELECT COUNT(*) FROM collections WHERE collections.user_id = users.id),
+                (SELECT COUNT(*) FROM journal_entries WHERE journal_entries.user_id = users.id)
+            FROM users
+            WHERE users.id NOT IN (SELECT user_id FROM user_stats)
+        """))
+
 def get_number_of_reviews_by_user(user_id):
     """Get number of reviews by user id"""
-    reviews = db.session.query(Reviews).filter(Reviews.user_id == user_id).all()
-    return len(reviews)
+    return get_user_stats(user_id).review_count
 
 def get_friend_count(user_id):
     """Get number of friends by user id"""
-    friends = db.session.query(Friendships).filter(
-        and_(
-            (Friendships.user_id1 == user_id) | (Friendships.user_id2 == user_id),
-            Friendships.status == "accepted"
-        )
-    ).all()
-    return len(friends)
+    return get_user_stats(user_id).friend_count
 
 def get_random_friend(user_id):
     """Get random friend by user id"""
@@ -562,6 +1492,36 @@ def get_random_friend(user_id):
 
 def get_random_user(user_id):
     """Get a random user not with the specified user id."""
-    user = db.session.query(Users).filter(Users.id != user_id).order_by(func.random()).first()
+    user = get_random_row(Users, exclude_id=user_id)
 
     return user
+
+def get_random_row(model, exclude_id=None):
+    """
+    Get a random row by probing random ids up to the largest one, which are
+    primary key lookups instead of a full scan and sort. Once the probes land
+    on gaps, takes the first row at or after a random id, wrapping around.
+    """
+    max_id = db.session.query(func.max(model.id)).scalar()
+
+    if max_id is None:
+        return None
+
+    query = db.session.query(model)
+
+    if exclude_id is not None:
+        query = query.filter(model.id != exclude_id)
+
+    for _ in range(RANDOM_PROBES):
+        row = query.filter(model.id == random.randint(1, max_id)).first()
+
+        if row:
+            return row
+
+    start = random.randint(1, max_id)
+    row = query.filter(model.id >= start).order_by(model.id).first()
+
+    if row is None:
+        row = query.filter(model.id < start).order_by(model.id).first()
+
+    return row
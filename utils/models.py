@@ -4,7 +4,11 @@ models.py
 ORM models for database and related classes.
 """
 
-from sqlalchemy import Integer, String, ForeignKey
+import json
+from dataclasses import dataclass, field
+from typing import Optional
+
+from sqlalchemy import Integer, String, Float, ForeignKey, Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from sqlalchemy.orm import DeclarativeBase
 
@@ -37,25 +41,92 @@ class Users(Base, UserMixin):
     def __repr__(self):
         return f"{self.username}: {self.bio}"
 
+class UserStats(Base):
+    """Per-user counters, kept up to date by the write paths in database.py"""
+    __tablename__ = "user_stats"
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), primary_key=True)
+    review_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    friend_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    collection_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    journal_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
 class Reviews(Base):
     """Reviews"""
     __tablename__ = "reviews"
+    __table_args__ = (
+        # One review per user and content; also serves lookups by user
+        Index("ix_reviews_user_content", "user_id", "content_id", "content_type", unique=True),
+        Index("ix_reviews_content", "content_type", "content_id"),
+        # A user's top-rated content, newest first
+        Index("ix_reviews_user_top", "user_id", "content_type", "rating", "created_at"),
+        # A user's reviews in pages, newest first
+        Index("ix_reviews_user_recent", "user_id", "id"),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), nullable=False)
     content_type: Mapped[str] = mapped_column(String, nullable=True)
     content_id: Mapped[int] = mapped_column(Integer, nullable=False)
     rating: Mapped[int] = mapped_column(Integer, nullable=False)
     text: Mapped[str] = mapped_column(String, nullable=True)
+    catalog_id: Mapped[int] = mapped_column(Integer, ForeignKey("content.id"), nullable=True)
+    created_at: Mapped[float] = mapped_column(Float, nullable=True) # None if posted before tracking
+    def to_dict(self):
+        """Convert the Reviews object to a dictionary, with its author's username."""
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "username": self.user.username,
+            "content_id": self.content_id,
+            "rating": self.rating,
+            "text": self.text,
+        }
     user = relationship("Users", back_populates="reviews")
+    catalog = relationship("Content", back_populates="reviews")
+
+class ContentStats(Base):
+    """Review aggregates per content, kept up to date by post_review and delete_review"""
+    __tablename__ = "content_stats"
+    __table_args__ = (
+        Index("ix_content_stats_trend", "content_type", "log_trend_score"),
+    )
+    content_type: Mapped[str] = mapped_column(String, primary_key=True)
+    content_id: Mapped[str] = mapped_column(String, primary_key=True)
+    review_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    rating_sum: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    # Number of reviews with each rating from 0 to 5
+    rating_0: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    rating_1: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    rating_2: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    rating_3: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    rating_4: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    rating_5: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    # log2 of the sum of the reviews' time-decayed weights, -inf without reviews;
+    # see trend_exponent in database.py
+    log_trend_score: Mapped[float] = mapped_column(Float, nullable=False,
+                                                   default=float("-inf"))
+
+    def average_rating(self):
+        """Mean rating, or None without reviews"""
+        return self.rating_sum / self.review_count if self.review_count else None
+
+    def histogram(self):
+        """Number of reviews per rating, from 0 to 5"""
+        return [getattr(self, f"rating_{rating}") for rating in range(6)]
 
 class JournalEntry(Base):
     """Journal Entry"""
     __tablename__ = "journal_entries"
+    __table_args__ = (
+        # One journal entry per user and content; also serves lookups by user
+        Index("ix_journal_entries_user_content", "user_id", "content_id", unique=True),
+        Index("ix_journal_entries_user_recent", "user_id", "id"),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), nullable=False)
     content_id: Mapped[int] = mapped_column(Integer, nullable=False)
     content_type: Mapped[str] = mapped_column(String, nullable=False)
     text: Mapped[str] = mapped_column(String, nullable=False)
+    catalog_id: Mapped[int] = mapped_column(Integer, ForeignKey("content.id"), nullable=True)
     def to_dict(self):
         """Convert the JournalEntry object to a dictionary."""
         return {
@@ -65,10 +136,14 @@ class JournalEntry(Base):
             "text": self.text,
         }
     user = relationship("Users", back_populates="journal_entries")
+    catalog = relationship("Content", back_populates="journal_entries")
 
 class Collections(Base):
     """Collections"""
     __tablename__ = "collections"
+    __table_args__ = (
+        Index("ix_collections_user_id", "user_id"),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     name: Mapped[str] = mapped_column(String, nullable=False)
     description: Mapped[str] = mapped_column(String, nullable=True)
@@ -78,16 +153,49 @@ class Collections(Base):
     user = relationship("Users", back_populates="collections")
 
 class Content(Base):
-    """Content"""
+    """Content, doubling as the local catalog of Spotify track/album metadata"""
     __tablename__ = "content"
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     spotify_id: Mapped[int] = mapped_column(Integer, nullable=False, unique=True)
     spotify_type: Mapped[str] = mapped_column(String, nullable=True)
+    name: Mapped[str] = mapped_column(String, nullable=True)
+    artists: Mapped[str] = mapped_column(String, nullable=True) # JSON list of artist names
+    image_large: Mapped[str] = mapped_column(String, nullable=True) # 640px
+    image_medium: Mapped[str] = mapped_column(String, nullable=True) # 300px
+    image_small: Mapped[str] = mapped_column(String, nullable=True) # 64px
+    fetched_at: Mapped[float] = mapped_column(Float, nullable=True) # None if never fetched
     content_collection = relationship("CollectionsContent", back_populates="content")
+    reviews = relationship("Reviews", back_populates="catalog")
+    journal_entries = relationship("JournalEntry", back_populates="catalog")
+
+    def set_metadata(self, content_item, fetched_at):
+        """Store metadata from a ContentItem fetched from Spotify."""
+        images = content_item.images or [content_item.image]
+
+        self.name = content_item.name
+        self.artists = json.dumps(content_item.artists or [])
+        self.image_large = images[0]
+        self.image_medium = images[1] if len(images) > 1 else images[0]
+        self.image_small = images[-1]
+        self.fetched_at = fetched_at
+
+    def to_content_item(self):
+        """ContentItem from the stored metadata, or None if it was never fetched."""
+        if self.fetched_at is None:
+            return None
+
+        artists = json.loads(self.artists) if self.artists else []
+        images = [self.image_large, self.image_medium, self.image_small]
+
+        return ContentItem(self.spotify_id, self.spotify_type, self.name,
+                           self.image_large, artists, images)
 
 class CollectionsContent(Base):
     """Maps content to collections"""
     __tablename__ = "collections_content"
+    __table_args__ = (
+        Index("ix_collections_content_collection", "collection_id", "content_id"),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     collection_id: Mapped[int] = mapped_column(Integer, ForeignKey("collections.id"))
     content_id: Mapped[int] = mapped_column(Integer, ForeignKey("content.id"))
@@ -97,6 +205,10 @@ class CollectionsContent(Base):
 class Friendships(Base):
     """Friendships"""
     __tablename__ = "friendships"
+    __table_args__ = (
+        Index("ix_friendships_user1_status", "user_id1", "status"),
+        Index("ix_friendships_user2_status", "user_id2", "status"),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     user_id1: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"))
     user_id2: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"))
@@ -106,12 +218,13 @@ class Friendships(Base):
 
 class ContentItem:
     """Generic representation of one data content item, used e.g. in search results."""
-    def __init__(self, content_id, content_type, name, image, artists=None):
+    def __init__(self, content_id, content_type, name, image, artists=None, images=None):
         self.content_id = content_id
         self.content_type = content_type
         self.name = name
         self.image = image
         self.artists = artists
+        self.images = images # image urls by size, largest first
 
     def __repr__(self):
         return f"{self.content_type}: {self.name}"
@@ -127,6 +240,18 @@ class ReviewContent:
         self.rating = rating
         self.text = text
 
+class TextSearchResult:
+    """A review or journal entry matching a text search, with its content."""
+    def __init__(self, kind, user, img, name, content_type, content_id, rating, text):
+        self.kind = kind # "review" or "journal"
+        self.user = user
+        self.img = img
+        self.name = name
+        self.content_type = content_type
+        self.content_id = content_id
+        self.rating = rating
+        self.text = text
+
 class JournalEntryContent:
     """Generic representation of a journal entry."""
     def __init__(self, img, name, content_type, content_id, text):
@@ -135,3 +260,22 @@ class JournalEntryContent:
         self.content_type = content_type
         self.content_id = content_id
         self.text = text
+
+@dataclass
+class ProfileView:
+    """Everything a profile page shows, with the first page of each tab."""
+    user: Users
+    stats: UserStats
+    reviews: list[ReviewContent] = field(default_factory=list)
+    collections: list[ContentItem] = field(default_factory=list)
+    friends: list[tuple[Users, int]] = field(default_factory=list)
+    pending_friends_sent: list[tuple[Users, int]] = field(default_factory=list)
+    pending_friends_received: list[tuple[Users, int]] = field(default_factory=list)
+    journal_entries: list[JournalEntryContent] = field(default_factory=list)
+    # Cursors for the next page of each tab, None on the last page
+    next_reviews: Optional[int] = None
+    next_collections: Optional[int] = None
+    next_friends: Optional[int] = None
+    next_pending_friends_sent: Optional[int] = None
+    next_pending_friends_received: Optional[int] = None
+    next_journal_entries: Optional[int] = None
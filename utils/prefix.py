@@ -0,0 +1,96 @@
+"""
+prefix.py
+
+In-process sorted index of names by word, for search-as-you-type.
+"""
+
+import bisect
+import threading
+
+class PrefixIndex:
+    """
+    Names kept as a sorted list of (word, id) pairs, so the names with a word
+    starting with some prefix are found by binary search, in the order a trie
+    would list them. Searches return ids, for the caller to load current rows.
+    """
+    def __init__(self, tokenize):
+        self.tokenize = tokenize
+        self._words = []
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def load(self, entries):
+        """Replaces the contents with (id, name) entries."""
+        items = {item_id: set(self.tokenize(name)) for item_id, name in entries}
+        words = sorted((word, item_id) for item_id, name_words in items.items()
+                       for word in name_words)
+
+        with self._lock:
+            self._items = items
+            self._words = words
+
+    def add(self, item_id, name):
+        """Adds a name, replacing any previous name with the same id."""
+        with self._lock:
+            self._remove(item_id)
+            self._items[item_id] = set(self.tokenize(name))
+
+            for word in self._items[item_id]:
+                bisect.insort(self._words, (word, item_id))
+
+    def remove(self, item_id):
+        """Removes the name with the given id if present."""
+        with self._lock:
+            self._remove(item_id)
+
+    def _remove(self, item_id):
+        if item_id not in self._items:
+            return
+
+        name_words = self._items.pop(item_id)
+
+        for word in name_words:
+            i = bisect.bisect_left(self._words, (word, item_id))
+
+            if i < len(self._words) and self._words[i] == (word, item_id):
+                del self._words[i]
+
+    def search(self, query, limit):
+        """
+        Ids of up to limit names where every word of query starts a word
+        of the name, ordered by the word matching the rarest query word.
+        """
+        tokens = self.tokenize(query)
+
+        if not tokens:
+            return []
+
+        results = []
+        seen = set()
+
+        with self._lock:
+            # Scan the narrowest range of words, checking the other query words per name
+            ranges = [(bisect.bisect_left(self._words, (token,)),
+                       bisect.bisect_left(self._words, (token + chr(0x10FFFF),)), token)
+                      for token in tokens]
+            i, end, first = min(ranges, key=lambda r: r[1] - r[0])
+            others = [token for _, _, token in ranges if token is not first]
+
+            # Stops after limit matches, so short prefixes cost no more than long ones
+            while i < end and len(results) < limit:
+                word, item_id = self._words[i]
+                i += 1
+
+                if item_id in seen:
+                    continue
+
+                seen.add(item_id)
+                name_words = self._items[item_id]
+
+                if all(any(w.startswith(token) for w in name_words) for token in others):
+                    results.append(item_id)
+
+        return results
+
+    def __len__(self):
+        return len(self._items)
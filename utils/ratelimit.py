@@ -0,0 +1,104 @@
+"""
+ratelimit.py
+
+Thread-safe admission control for outbound calls: a token bucket and a circuit breaker.
+"""
+
+import threading
+import time
+
+class TokenBucket:
+    """
+    Token bucket allowing rate calls per second on average, in bursts of up to
+    capacity. Can be paused, e.g. while a server asks us to back off.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, max_wait):
+        """Takes a token, waiting up to max_wait seconds. Returns False if none is free in time."""
+        deadline = time.monotonic() + max_wait
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity,
+                                   self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+
+                # Time until a token is free, or until the pause is over
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+
+            if now + wait > deadline:
+                return False
+
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Hand out no tokens for the next seconds."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def paused_for(self):
+        """Seconds left in the current pause, if any."""
+        return max(0, self._paused_until - time.monotonic())
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures so calls fail fast, then
+    lets one trial call through after reset_timeout seconds to probe for recovery.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may go out now."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                # Let exactly one trial call through
+                self.state = self.HALF_OPEN
+                return True
+
+            return False
+
+    def release(self):
+        """Gives back a trial call that ended without an outcome, so another call can probe."""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def record_success(self):
+        """Closes the circuit again."""
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        """Counts a failure, opening the circuit at the threshold or if a trial call failed."""
+        with self._lock:
+            self._failures += 1
+
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
@@ -0,0 +1,118 @@
+"""
+search.py
+
+Search pipeline combining Spotify and Reverb results.
+"""
+
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from utils.cache import LRUCache
+from utils.spotify import spotify_search_item, submit_with_budget, remaining_budget
+from utils.database import get_reverb_results, reverb_name_matches, REVERB_SEARCH_LIMIT
+
+# Seconds each search source gets before its results are left out
+SEARCH_DEADLINE = float(os.getenv("SEARCH_DEADLINE", "2"))
+
+# Threads running Spotify searches, two per search request
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", "8"))
+
+# Cached results per search source, keyed by source and normalized query
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "2000"))
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "60"))
+
+# Answer Reverb user/collection searches by filtering the cached results of a shorter prefix
+SEARCH_PREFIX_REUSE = os.getenv("SEARCH_PREFIX_REUSE", "1") == "1"
+
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="search")
+search_cache = LRUCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+
+def normalize_query(query):
+    """Collapse whitespace and case so equivalent queries share cache entries"""
+    return " ".join(query.split()).casefold()
+
+def cached_spotify_search(query, content_type):
+    """Spotify search for tracks or albums, cached by normalized query"""
+    key = ("spotify", content_type, query)
+
+    results = search_cache.get(key)
+
+    if results is None:
+        results = spotify_search_item(query, content_type)
+        search_cache.set(key, results)
+
+    return results
+
+def cached_reverb_search(query, content_type):
+    """Reverb search for users or collections, cached by normalized query"""
+    key = ("reverb", content_type, query)
+
+    results = search_cache.get(key)
+
+    if results is not None:
+        return results
+
+    if SEARCH_PREFIX_REUSE:
+        # Every name matching the query also matches its prefixes, so the
+        # longest cached prefix holds a superset of the matches, unless the
+        # prefix's results were cut off at the limit
+        for end in range(len(query) - 1, 0, -1):
+            prefix_results = search_cache.get(("reverb", content_type, query[:end]))
+
+            if prefix_results is not None and len(prefix_results) < REVERB_SEARCH_LIMIT:
+                # Not cached itself, so entries never outlive their prefix's TTL
+                return [r for r in prefix_results if reverb_name_matches(query, r.name)]
+
+    results = get_reverb_results(query, content_type == "user", content_type == "collection")
+    search_cache.set(key, results)
+
+    return results
+
+def search_all(query, filters, deadline=SEARCH_DEADLINE):
+    """
+    Run the requested search sources concurrently and merge their results.
+    Sources that fail or miss the deadline are left out, so partial results are
+    returned instead of waiting on a slow source.
+    """
+    start = time.monotonic()
+    query = normalize_query(query)
+
+    # Spotify searches run in the pool
+    futures = []
+    for content_type in ["track", "album"]:
+        if filters[content_type] == "true":
+            futures.append(submit_with_budget(search_executor, cached_spotify_search,
+                                              query, content_type))
+
+    # Reverb results use the request's database session, so they run here meanwhile
+    reverb_results = []
+    for content_type in ["user", "collection"]:
+        if filters[content_type] == "true":
+            reverb_results += cached_reverb_search(query, content_type)
+
+    remaining = deadline - (time.monotonic() - start)
+
+    # The page's own latency budget may be tighter than the search deadline
+    budget = remaining_budget()
+    if budget is not None:
+        remaining = min(remaining, budget)
+
+    remaining = max(0, remaining)
+    done, _ = wait(futures, timeout=remaining)
+
+    # Keep track results before album results
+    results = []
+    for future in futures:
+        if future not in done:
+            # Cancelled if not started yet, otherwise it finishes in the background
+            future.cancel()
+            print(f"Search source timed out for query {query!r}", file=sys.stderr)
+        elif future.exception() is not None:
+            print(f"Search source failed for query {query!r}: {future.exception()!r}",
+                  file=sys.stderr)
+        else:
+            results += future.result()
+
+    return results + reverb_results
@@ -9,196 +9,839 @@ import base64
 import json
 import string
 import random
+import tempfile
+import threading
+import sys
+import time
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
 
 from dotenv import load_dotenv
-from requests import post, get
+from requests import Session, RequestException
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from utils.models import ContentItem
+from utils.cache import LRUCache, SingleFlight
+from utils.ratelimit import TokenBucket, CircuitBreaker
 
 load_dotenv()
 
 client_id = os.getenv("CLIENT_ID")
 client_secret = os.getenv("CLIENT_SECRET")
 
-SPOTIFY_ENDPOINT = "https://api.spotify.com/v1/"
+# Both can point at a local stand-in (see fake_spotify.py) for offline testing
+SPOTIFY_ENDPOINT = os.getenv("SPOTIFY_ENDPOINT", "https://api.spotify.com/v1/")
+SPOTIFY_TOKEN_URL = os.getenv("SPOTIFY_TOKEN_URL", "https://accounts.spotify.com/api/token")
 
-def get_token():
-    """Get token from Spotify API"""
+# Connection pool size should match the number of server worker threads
+SPOTIFY_POOL_SIZE = int(os.getenv("SPOTIFY_POOL_SIZE", "10"))
+SPOTIFY_CONNECT_TIMEOUT = float(os.getenv("SPOTIFY_CONNECT_TIMEOUT", "3"))
+SPOTIFY_READ_TIMEOUT = float(os.getenv("SPOTIFY_READ_TIMEOUT", "5"))
+
+# Client-side request quota: average requests per second and largest burst, and
+# seconds a call may wait for a free slot before failing fast
+SPOTIFY_RATE = float(os.getenv("SPOTIFY_RATE", "10"))
+SPOTIFY_BURST = int(os.getenv("SPOTIFY_BURST", "20"))
+SPOTIFY_MAX_WAIT = float(os.getenv("SPOTIFY_MAX_WAIT", "1"))
+
+# Attempts per call for transient errors, and consecutive failures that open
+# the circuit breaker for SPOTIFY_BREAKER_RESET seconds
+SPOTIFY_MAX_ATTEMPTS = int(os.getenv("SPOTIFY_MAX_ATTEMPTS", "3"))
+SPOTIFY_BREAKER_THRESHOLD = int(os.getenv("SPOTIFY_BREAKER_THRESHOLD", "5"))
+SPOTIFY_BREAKER_RESET = float(os.getenv("SPOTIFY_BREAKER_RESET", "30"))
+
+# Default total seconds a page may spend waiting on Spotify
+PAGE_BUDGET = float(os.getenv("PAGE_BUDGET", "2"))
+
+# Most ids accepted by one several tracks/albums request
+MAX_IDS_PER_REQUEST = {"track": 50, "album": 20}
+
+# Threads fetching chunks of a large batch lookup concurrently
+SPOTIFY_BATCH_WORKERS = int(os.getenv("SPOTIFY_BATCH_WORKERS", "4"))
+
+# Seconds single-id lookups wait for others to share a multi-id request with
+SPOTIFY_BATCH_WINDOW = float(os.getenv("SPOTIFY_BATCH_WINDOW", "0.005"))
+
+# Size and seconds to live of the in-process track/album metadata cache
+METADATA_CACHE_SIZE = int(os.getenv("METADATA_CACHE_SIZE", "5000"))
+METADATA_CACHE_TTL = int(os.getenv("METADATA_CACHE_TTL", "3600"))
+
+# Seconds between background refreshes of the random content pool, and the
+# number of random searches per content type used to fill it
+CONTENT_POOL_REFRESH = int(os.getenv("CONTENT_POOL_REFRESH", "900"))
+CONTENT_POOL_SEARCHES = int(os.getenv("CONTENT_POOL_SEARCHES", "10"))
+
+# Seconds between refreshes while part of the content pool is still empty
+CONTENT_POOL_RETRY = int(os.getenv("CONTENT_POOL_RETRY", "30"))
+
+# Optional path of a small JSON file used to share the token between worker processes
+SPOTIFY_TOKEN_CACHE = os.getenv("SPOTIFY_TOKEN_CACHE")
+
+class SpotifyError(Exception):
+    """A Spotify API call failed, with the HTTP status if Spotify answered"""
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+class SpotifyUnavailable(SpotifyError):
+    """Spotify is degraded or rate limiting us; callers should fall back to cached data"""
+
+class SpotifyTimeout(SpotifyUnavailable):
+    """The current page's latency budget ran out before Spotify answered"""
+
+# Monotonic time by which the current request must be done with Spotify, if any
+request_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+def remaining_budget():
+    """Seconds left in the current request's latency budget, or None if unbounded"""
+    deadline = request_deadline.get()
+
+    return None if deadline is None else deadline - time.monotonic()
+
+def has_budget_left():
+    """Whether the current request's latency budget, if any, has time left"""
+    remaining = remaining_budget()
+
+    return remaining is None or remaining > 0
+
+def latency_budget(seconds=PAGE_BUDGET):
+    """
+    Decorator giving a route a total latency budget. Every Spotify call made
+    while it runs gets the remaining budget as its timeout.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            reset_token = request_deadline.set(time.monotonic() + seconds)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                request_deadline.reset(reset_token)
+
+        return wrapper
+
+    return decorator
+
+def lock_timeout():
+    """
+    Seconds a lock may be waited for within the latency budget, -1 (no limit)
+    without one. Raises SpotifyTimeout if the budget has run out.
+    """
+    remaining = remaining_budget()
+
+    if remaining is None:
+        return -1
+
+    if remaining <= 0:
+        raise SpotifyTimeout("Latency budget ran out waiting for a Spotify token")
+
+    return remaining
+
+def lock_exclusive(lock_file, poll_interval=0.01):
+    """Take an exclusive file lock, polling for it until the latency budget runs out"""
+    timeout = lock_timeout()
+
+    if timeout < 0:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return
+
+    deadline = time.monotonic() + timeout
+
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except BlockingIOError as ex:
+            if time.monotonic() >= deadline:
+                raise SpotifyTimeout("Latency budget ran out waiting for a Spotify token") from ex
+
+            time.sleep(poll_interval)
+
+def submit_with_budget(executor, fn, *args):
+    """Submit fn to a thread pool, carrying over the current latency budget"""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+class TokenManager:
+    """
+    Caches the client credentials token until shortly before it expires.
+    Refreshes happen once under a lock, and the token is optionally shared
+    with other worker processes through a file.
+    """
+    def __init__(self, cache_path=None, leeway=60):
+        self.cache_path = cache_path
+        self.leeway = leeway
+        self._token = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+
+    def _is_fresh(self):
+        return self._token is not None and time.time() < self._expires_at - self.leeway
+
+    def get(self):
+        """
+        Returns a valid token, requesting a new one only if the cached one is stale.
+        Waiting for another refresh is bounded by the latency budget (SpotifyTimeout).
+        """
+        if self._is_fresh():
+            return self._token
+
+        if not self._lock.acquire(timeout=lock_timeout()):
+            raise SpotifyTimeout("Latency budget ran out waiting for a Spotify token")
+
+        try:
+            # Another thread may have refreshed while we were waiting
+            if self._is_fresh():
+                return self._token
+
+            if self.cache_path:
+                self._refresh_shared()
+            else:
+                self._refresh()
+
+            return self._token
+        finally:
+            self._lock.release()
+
+    def invalidate(self):
+        """Forget the cached token, e.g. after Spotify rejects it."""
+        with self._lock:
+            self._token = None
+            self._expires_at = 0
+
+    def _refresh(self):
+        token, expires_in = request_token()
+        self._token = token
+        self._expires_at = time.time() + expires_in
+
+    def _refresh_shared(self):
+        # Hold an exclusive file lock so only one process asks Spotify for a new token
+        with open(self.cache_path + ".lock", "a", encoding="utf-8") as lock_file:
+            if fcntl:
+                lock_exclusive(lock_file)
+
+            try:
+                if self._read_cache_file() and self._is_fresh():
+                    return
+
+                self._refresh()
+                self._write_cache_file()
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_cache_file(self):
+        try:
+            with open(self.cache_path, encoding="utf-8") as cache_file:
+                cached = json.load(cache_file)
+
+            self._token = cached["access_token"]
+            self._expires_at = cached["expires_at"]
+            return True
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def _write_cache_file(self):
+        directory = os.path.dirname(os.path.abspath(self.cache_path))
+
+        try:
+            # Write to a temporary file first so readers never see a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, "w", encoding="utf-8") as tmp_file:
+                json.dump({"access_token": self._token, "expires_at": self._expires_at}, tmp_file)
+
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            # The in-process cache still works without the shared file
+            pass
+
+class SpotifyClient:
+    """
+    Client for the Spotify API owning a pooled keep-alive session, so calls
+    reuse TCP/TLS connections instead of opening a new one each time.
+    Outbound calls are admitted by a token bucket and a circuit breaker.
+    """
+    def __init__(self, endpoint=SPOTIFY_ENDPOINT, pool_size=SPOTIFY_POOL_SIZE,
+                 timeout=(SPOTIFY_CONNECT_TIMEOUT, SPOTIFY_READ_TIMEOUT), retries=2,
+                 max_attempts=SPOTIFY_MAX_ATTEMPTS, max_wait=SPOTIFY_MAX_WAIT, backoff=0.2):
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.max_wait = max_wait
+        self.backoff = backoff
+
+        # Retry only failures to connect. Read errors are left to _get, where
+        # retries count against the latency budget and the circuit breaker
+        retry = Retry(total=retries, connect=retries, read=0, status=0,
+                      backoff_factor=0.1, allowed_methods=frozenset(["GET", "POST"]))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=retry)
+
+        self.session = Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.in_flight = SingleFlight()
+        self.bucket = TokenBucket(SPOTIFY_RATE, SPOTIFY_BURST)
+        self.breaker = CircuitBreaker(SPOTIFY_BREAKER_THRESHOLD, SPOTIFY_BREAKER_RESET)
+
+    def get(self, path, params=None, timeout=None):
+        """
+        GET a Spotify API path (relative to the endpoint), returns the decoded JSON.
+        Concurrent identical requests share one outbound call.
+        Raises SpotifyUnavailable when Spotify is degraded, SpotifyError for other errors.
+        """
+        key = (path, tuple(sorted((params or {}).items())))
+
+        while True:
+            try:
+                return self.in_flight.do(key, self._get, path, params, timeout,
+                                         timeout=remaining_budget())
+            except FutureTimeoutError as ex:
+                raise SpotifyTimeout("Latency budget ran out waiting for Spotify") from ex
+            except SpotifyTimeout:
+                # The shared call ran under another caller's budget; with some of
+                # ours left, make or join a new call instead of failing with it
+                if not has_budget_left():
+                    raise
+
+    def _timeouts(self, timeout):
+        # Per-call (connect, read) timeouts, capped by the remaining latency budget
+        connect_timeout, read_timeout = timeout or self.timeout
+        remaining = remaining_budget()
+
+        if remaining is None:
+            return connect_timeout, read_timeout
+
+        if remaining <= 0:
+            raise SpotifyTimeout("Latency budget ran out before calling Spotify")
+
+        return min(connect_timeout, remaining), min(read_timeout, remaining)
+
+    def _get(self, path, params, timeout):
+        url = self.endpoint + path
+        error = None
+        token_refreshed = False
+
+        for attempt in range(self.max_attempts):
+            header = get_auth_header(get_token())
+            timeouts = self._timeouts(timeout)
+
+            if not self.breaker.allow():
+                raise SpotifyUnavailable("Spotify circuit breaker is open")
+
+            if not self.bucket.acquire(min(self.max_wait, timeouts[1])):
+                # Nothing went out, so a trial call must not keep the breaker half-open
+                self.breaker.release()
+                raise SpotifyUnavailable("Spotify request quota exhausted", 429)
+
+            try:
+                response = self.session.get(url, params=params, headers=header,
+                                            timeout=timeouts)
+            except RequestException as ex:
+                if not has_budget_left():
+                    # Our own budget ran out, which says nothing about Spotify's health,
+                    # whatever the error it surfaced as
+                    self.breaker.release()
+                    raise SpotifyTimeout("Latency budget ran out waiting for Spotify") from ex
+
+                self.breaker.record_failure()
+                error = SpotifyUnavailable(f"Spotify request failed: {ex}")
+                self._sleep_backoff(attempt)
+                continue
+            except BaseException:
+                self.breaker.release()
+                raise
+
+            status = response.status_code
+
+            if status >= 500:
+                self.breaker.record_failure()
+                error = SpotifyUnavailable(f"Spotify returned {status}", status)
+                self._sleep_backoff(attempt)
+                continue
+
+            # Spotify answered, so it is not degraded even if the request was refused
+            self.breaker.record_success()
+
+            if status == 429:
+                # Every thread holds off until Spotify's Retry-After has passed
+                self.bucket.pause(parse_retry_after(response.headers.get("Retry-After")))
+                error = SpotifyUnavailable("Spotify rate limit exceeded", status)
+                continue
+
+            if status == 401 and not token_refreshed:
+                token_manager.invalidate()
+                token_refreshed = True
+                continue
+
+            if status >= 400:
+                raise SpotifyError(f"Spotify returned {status} for {path}", status)
+
+            return json.loads(response.content)
+
+        raise error
+
+    def _sleep_backoff(self, attempt):
+        # Full jitter exponential backoff, skipped after the last attempt
+        if attempt < self.max_attempts - 1:
+            delay = random.uniform(0, self.backoff * 2 ** attempt)
+            remaining = remaining_budget()
+
+            time.sleep(delay if remaining is None else max(0, min(delay, remaining)))
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        """POST to an absolute url, returns the decoded JSON. Admitted by the circuit breaker."""
+        timeouts = self._timeouts(timeout)
+
+        if not self.breaker.allow():
+            raise SpotifyUnavailable("Spotify circuit breaker is open")
+
+        try:
+            response = self.session.post(url, headers=headers, data=data, timeout=timeouts)
+        except RequestException as ex:
+            if not has_budget_left():
+                self.breaker.release()
+                raise SpotifyTimeout("Latency budget ran out waiting for Spotify") from ex
+
+            self.breaker.record_failure()
+            raise SpotifyUnavailable(f"Spotify request failed: {ex}") from ex
+        except BaseException:
+            self.breaker.release()
+            raise
+
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+        if response.status_code >= 500 or response.status_code == 429:
+            raise SpotifyUnavailable(f"Spotify returned {response.status_code}",
+                                     response.status_code)
+
+        if response.status_code >= 400:
+            raise SpotifyError(f"Spotify returned {response.status_code}", response.status_code)
+
+        return json.loads(response.content)
+
+def parse_retry_after(value, default=1):
+    """Seconds to wait from a Retry-After header"""
+    try:
+        return max(0, float(value))
+    except (TypeError, ValueError):
+        return default
+
+class MetadataCache:
+    """
+    Two-tier cache of track/album metadata keyed by (content type, content id):
+    an in-process LRU in front of an optional persistent store (set up by the database).
+    """
+    def __init__(self, maxsize=METADATA_CACHE_SIZE, ttl=METADATA_CACHE_TTL, store=None):
+        self.memory = LRUCache(maxsize, ttl)
+        self.store = store
+
+    def get_many(self, keys, allow_stale=False):
+        """
+        Returns cached ContentItems for the keys found, as a dict by key.
+        allow_stale includes expired entries, for use while Spotify is unavailable.
+        """
+        found = {}
+        missing = []
+
+        for key in keys:
+            item = self.memory.get(key, allow_stale=allow_stale)
+
+            if item is None:
+                missing.append(key)
+            else:
+                found[key] = item
+
+        if missing and self.store:
+            stored = self.store.get_many(missing, allow_stale=allow_stale)
+
+            # Promote persisted hits to the in-process tier
+            for key, item in stored.items():
+                self.memory.set(key, item)
+
+            found.update(stored)
+
+        return found
+
+    def put_many(self, items):
+        """Caches ContentItems in both tiers"""
+        for item in items:
+            self.memory.set((item.content_type, item.content_id), item)
+
+        if self.store:
+            self.store.put_many(items)
+
+class ContentPool:
+    """
+    Pool of popular tracks and albums, filled by random searches in a background
+    thread started at startup and refreshed periodically, so random content never
+    waits on Spotify. Until the first refresh of a type lands, it has no items.
+    """
+    def __init__(self, refresh_interval=CONTENT_POOL_REFRESH, searches=CONTENT_POOL_SEARCHES,
+                 top=10, retry_interval=CONTENT_POOL_RETRY):
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+        self.searches = searches
+        self.top = top
+        self._items = {"track": [], "album": []}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Start the background thread filling and refreshing the pool, once."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="content-pool",
+                                                daemon=True)
+                self._thread.start()
+
+    def sample(self, content_type, n):
+        """Returns up to n distinct random items of the specified type, possibly none."""
+        items = self._items[content_type]
+
+        return random.sample(items, min(n, len(items)))
+
+    def refresh(self, content_type):
+        """Replace the pool of one type with the results of new random searches."""
+        items = {}
+
+        for _ in range(self.searches):
+            random_search = f"%{random.choice(string.ascii_letters + string.digits)}%"
+
+            try:
+                results = spotify_search_item(random_search, content_type, number=self.top)
+            except SpotifyUnavailable:
+                # Keep what earlier searches found
+                break
+
+            for item in results:
+                items[item.content_id] = item
+
+        # Swap in the new list whole so readers never see a partial pool
+        if items:
+            self._items[content_type] = list(items.values())
+
+    def refresh_all(self):
+        """Refresh the pool of each type on its own, so one failing leaves the others alone."""
+        for content_type in self._items:
+            try:
+                self.refresh(content_type)
+            except Exception as ex:
+                # Keep serving the previous pool of this type until the next refresh
+                print(f"Content pool refresh failed for {content_type}s: {ex!r}",
+                      file=sys.stderr)
+
+    def _run(self):
+        while True:
+            self.refresh_all()
+
+            # Try again sooner while a type is still empty, e.g. Spotify was down at startup
+            time.sleep(self.refresh_interval if all(self._items.values())
+                       else self.retry_interval)
+
+class MetadataBatcher:
+    """
+    Merges single-id track/album lookups from different threads arriving within
+    a short window into one multi-id request, delivering each caller its own item.
+    """
+    def __init__(self, window=SPOTIFY_BATCH_WINDOW):
+        self.window = window
+        self._open = {"track": None, "album": None}
+        self._lock = threading.Lock()
+
+    def load(self, content_type, content_id):
+        """Returns the ContentItem for the id, or None if Spotify does not know it."""
+        if self.window <= 0:
+            return fetch_several_ids(content_type, [content_id]).get(content_id)
+
+        with self._lock:
+            batch = self._open[content_type]
+            leader = batch is None
+
+            if leader:
+                batch = {}
+                self._open[content_type] = batch
+
+            future = batch.setdefault(content_id, Future())
+
+            # A full batch is closed and sent right away by whoever filled it
+            full = len(batch) >= MAX_IDS_PER_REQUEST[content_type]
+            if full:
+                self._open[content_type] = None
+
+        if full:
+            self._dispatch(content_type, batch)
+        elif leader:
+            # The thread that opened the batch sends it once the window has passed
+            time.sleep(self.window)
+
+            with self._lock:
+                still_open = self._open[content_type] is batch
+                if still_open:
+                    self._open[content_type] = None
+
+            if still_open:
+                self._dispatch(content_type, batch)
+
+        try:
+            return future.result(timeout=remaining_budget())
+        except FutureTimeoutError as ex:
+            raise SpotifyTimeout("Latency budget ran out waiting for Spotify") from ex
+        except SpotifyTimeout:
+            # The batch was sent under another caller's budget; use what is left of ours
+            if not has_budget_left():
+                raise
+
+            return fetch_several_ids(content_type, [content_id]).get(content_id)
+
+    def _dispatch(self, content_type, batch):
+        try:
+            items = fetch_several_ids(content_type, list(batch))
+        except Exception as ex:
+            for future in batch.values():
+                future.set_exception(ex)
+            return
+
+        for content_id, future in batch.items():
+            future.set_result(items.get(content_id))
+
+token_manager = TokenManager(SPOTIFY_TOKEN_CACHE)
+spotify_client = SpotifyClient()
+metadata_cache = MetadataCache()
+batch_executor = ThreadPoolExecutor(max_workers=SPOTIFY_BATCH_WORKERS,
+                                    thread_name_prefix="spotify-batch")
+content_pool = ContentPool()
+metadata_batcher = MetadataBatcher()
+
+def request_token():
+    """Request a new token from Spotify API, returns the token and its lifetime in seconds"""
     auth_string = client_id + ":" + client_secret
     auth_bytes = auth_string.encode("utf-8")
     auth_base64 = str(base64.b64encode(auth_bytes), "utf-8")
 
-    url = "https://accounts.spotify.com/api/token"
+    url = SPOTIFY_TOKEN_URL
     headers = {
         "Authorization": "Basic " + auth_base64,
         "Content-Type": "application/x-www-form-urlencoded"
     }
 
     data = {"grant_type": "client_credentials"}
-    result = post(url, headers=headers, data=data)
-    json_result = json.loads(result.content)
+    json_result = spotify_client.post(url, headers=headers, data=data)
     token = json_result["access_token"]
+    expires_in = json_result.get("expires_in", 3600)
 
-    return token
+    return token, expires_in
+
+def get_token():
+    """Get token from Spotify API, cached until shortly before it expires"""
+    return token_manager.get()
 
 def get_auth_header(token):
     """Get auth header"""
     return { "Authorization": "Bearer " + token}
 
+def parse_content_item(item, content_type):
+    """Format a track or album object from the Spotify API into a ContentItem"""
+    # index correctly into json based for track or album response, then select first image url
+    images_list = item["album"]["images"] if content_type == "track" else item["images"]
+    image = images_list[0]["url"] if images_list else None
+
+    artists = []
+    for artist in item["artists"]:
+        artists.append(artist["name"])
+
+    images = [image_size["url"] for image_size in images_list]
+
+    return ContentItem(item["id"], content_type, item["name"], image, artists, images)
+
 # See https://developer.spotify.com/web-api/search-item/ for documentation
-def spotify_search_item(name, content_type, token, number=10):
+def spotify_search_item(name, content_type, number=10):
     """Queries spotify for content by type (track or album) in US market"""
-    header = get_auth_header(token)
-
-    query = f"?q={name}&type={content_type}&limit={number}&market=US"
-    query_url = SPOTIFY_ENDPOINT + "search" + query
+    params = {"q": name, "type": content_type, "limit": number, "market": "US"}
 
-    response = get(query_url, headers=header)
+    response = spotify_client.get("search", params=params)
     content_type_index = content_type + "s"
-    items = json.loads(response.content)[content_type_index]["items"]
+    items = response[content_type_index]["items"]
 
     content = []
     for item in items:
-        content_id = item["id"]
-        name = item["name"]
-
-        # index correctly into json based for track or album response, then select first image url
-        images_list = item["album"]["images"] if content_type == "track" else item["images"]
-        image = images_list[0]["url"] if images_list else None
-
-        artists = []
-        for artist in item["artists"]:
-            artists.append(artist["name"])
-
         # format into content display class
-        content_item = ContentItem(content_id, content_type, name, image, artists)
+        content_item = parse_content_item(item, content_type)
         content.append(content_item)
 
     return content
 
 def get_spotify_results(name, track, album):
     """Returns track and/or album results as requested."""
-    token = get_token()
-
     results = []
 
     if track:
-        tracks = spotify_search_item(name, "track", token)
+        tracks = spotify_search_item(name, "track")
         results += tracks
 
     if album:
-        albums = spotify_search_item(name, "album", token)
+        albums = spotify_search_item(name, "album")
         results += albums
 
     return results
 
-def get_random_content(content_type, n, top=10):
-    """Returns n random content items of the specified type."""
-    token = get_token()
-
-    results = []
-
-    for _ in range(n):
-        random_search = f"%25{random.choice(string.ascii_letters + string.digits)}%25"
-        content = spotify_search_item(random_search, content_type, token, number=top)
+def placeholder_content(content_type, content_id):
+    """Stand-in for content whose metadata could not be loaded in time"""
+    return ContentItem(content_id, content_type, "Unavailable", None, [])
 
-        while True:
-            result = random.sample(content, 1)
-
-            if result not in results:
-                results += random.sample(content, 1)
-                break
-
-    return results
+def get_random_content(content_type, n):
+    """
+    Returns up to n random content items of the specified type from the popular
+    content pool, fewer or none while the pool is still being filled.
+    """
+    return content_pool.sample(content_type, n)
 
 def get_content_image(content_type, content_id):
-    """Get content name, image, and artists if any from content id and type"""
-    token = get_token()
-    header = get_auth_header(token)
-
-    content_type_plural = content_type + "s"
-    query_url = SPOTIFY_ENDPOINT + f"{content_type_plural}/" + f"{content_id}"
-
-    response = get(query_url, headers=header)
-    item = json.loads(response.content)
+    """Get content image from content id and type"""
+    content_item = get_content_info(content_type, content_id)
 
-    # index correctly into json based for track or album response, then select first image url
-    images_list = item["album"]["images"] if content_type == "track" else item["images"]
-    image = images_list[0]["url"] if images_list else None
-
-    return image
+    return content_item.image if content_item else None
 
 def get_content_info(content_type, content_id):
-    """Get content name, image, and artists if any from content id and type"""
-    token = get_token()
-    header = get_auth_header(token)
-
-    content_type_plural = content_type + "s"
-    query_url = SPOTIFY_ENDPOINT + f"{content_type_plural}/" + f"{content_id}"
-
-    response = get(query_url, headers=header)
-    item = json.loads(response.content)
-
-    # To-do: error checking when id doesnt exist
-    # if item["error"]:
-    #     return None
-
-    name = item["name"]
-
-    # index correctly into json based for track or album response, then select first image url
-    images_list = item["album"]["images"] if content_type == "track" else item["images"]
-    image = images_list[0]["url"] if images_list else None
-
-    artists = []
-    for artist in item["artists"]:
-        artists.append(artist["name"])
-
-    content_item = ContentItem(content_id, content_type, name, image, artists)
+    """
+    Get content name, image, and artists if any from content id and type,
+    or None if the id does not exist
+    """
+    key = (content_type, content_id)
+
+    cached = metadata_cache.get_many([key])
+    if key in cached:
+        return cached[key]
+
+    # Concurrent lookups are merged into one multi-id request
+    try:
+        content_item = metadata_batcher.load(content_type, content_id)
+    except SpotifyUnavailable:
+        # Serve expired cached data while Spotify is degraded
+        stale = metadata_cache.get_many([key], allow_stale=True)
+        if key in stale:
+            return stale[key]
+
+        raise
+
+    if content_item is not None:
+        metadata_cache.put_many([content_item])
 
     return content_item
 
-def get_content_several_ids(content):
-    """Get content name and image from id and type for several ids"""
-    token = get_token()
-    header = get_auth_header(token)
-
-    track_ids = ",".join(content["tracks"])
-    album_ids = ",".join(content["albums"])
-
-    tracks_query = SPOTIFY_ENDPOINT + f"tracks?market=US&ids={track_ids}"
-    albums_query =  SPOTIFY_ENDPOINT + f"albums?market=US&ids={album_ids}"
-
-    content = []
-
-    # To-do: make helper function for similar code
-    if track_ids:
-        response = get(tracks_query, headers=header)
-        tracks = json.loads(response.content)["tracks"]
-
-        for track in tracks:
-            images_list = track["album"]["images"]
-            image = images_list[0]["url"] if images_list else None
-
-            artists = []
-            for artist in track["artists"]:
-                artists.append(artist["name"])
-
-            content_item = ContentItem(track["id"], "track", track["name"], image, artists)
-            content.append(content_item)
-
-    if album_ids:
-        response = get(albums_query, headers=header)
-        albums = json.loads(response.content)["albums"]
-
-        for album in albums:
-            images_list = album["images"]
-            image = images_list[0]["url"] if images_list else None
-
-            artists = []
-            for artist in album["artists"]:
-                artists.append(artist["name"])
-
-            content_item = ContentItem(album["id"], "album", album["name"], image, artists)
-            content.append(content_item)
+def fetch_several_ids(content_type, content_ids):
+    """
+    Fetch up to MAX_IDS_PER_REQUEST tracks or albums from Spotify in one request,
+    as a dict by id. Ids Spotify does not know (null entries) are left out.
+    """
+    content_type_plural = content_type + "s"
+    params = {"market": "US", "ids": ",".join(content_ids)}
+
+    try:
+        response = spotify_client.get(content_type_plural, params=params)
+    except SpotifyError as ex:
+        if ex.status not in (400, 404):
+            raise
+
+        # A malformed id fails the whole request, so retry one by one to find it
+        items = {}
+        if len(content_ids) > 1:
+            for content_id in content_ids:
+                items.update(fetch_several_ids(content_type, [content_id]))
+
+        return items
+
+    # Results come back in request order; key them by the requested id since
+    # market relinking can return a different track id
+    items = {}
+    for content_id, item in zip(content_ids, response[content_type_plural]):
+        if item is None:
+            continue
+
+        content_item = parse_content_item(item, content_type)
+        content_item.content_id = content_id
+        items[content_id] = content_item
+
+    return items
+
+def fetch_many_ids(ids_by_type):
+    """
+    Fetch any number of tracks and albums, split into API-sized chunks that are
+    requested concurrently. Returns a dict by (content type, content id).
+    """
+    chunks = []
+    for content_type, content_ids in ids_by_type.items():
+        size = MAX_IDS_PER_REQUEST[content_type]
+
+        for i in range(0, len(content_ids), size):
+            chunks.append((content_type, content_ids[i:i + size]))
+
+    # A single chunk is fetched directly to skip the thread handoff
+    if len(chunks) == 1:
+        futures = [None]
+    else:
+        futures = [submit_with_budget(batch_executor, fetch_several_ids, *chunk)
+                   for chunk in chunks]
+
+    found = {}
+    for chunk, future in zip(chunks, futures):
+        try:
+            if future:
+                items = future.result(timeout=remaining_budget())
+            else:
+                items = fetch_several_ids(*chunk)
+        except FutureTimeoutError:
+            print("Spotify batch lookup ran out of latency budget", file=sys.stderr)
+            continue
+        except SpotifyUnavailable as ex:
+            # Leave the chunk out so the page renders with what is available
+            print(f"Spotify batch lookup failed: {ex!r}", file=sys.stderr)
+            continue
+
+        for content_id, item in items.items():
+            found[(chunk[0], content_id)] = item
+
+    return found
 
-    return content
+def get_content_several_ids(content):
+    """
+    Get content name and image from id and type for several ids.
+    Cached content is resolved locally and only the misses are sent to Spotify.
+    Returns tracks then albums, in the order requested, skipping unavailable ids.
+    """
+    keys = []
+    for content_type in ["track", "album"]:
+        for content_id in content[content_type + "s"]:
+            if content_id:
+                keys.append((content_type, content_id))
+
+    found = metadata_cache.get_many(keys)
+
+    missing = {}
+    for key in keys:
+        if key not in found:
+            missing.setdefault(key[0], {})[key[1]] = None
+
+    if missing:
+        # dicts dedupe the ids while keeping order
+        fetched = fetch_many_ids({content_type: list(ids) for content_type, ids in missing.items()})
+
+        found.update(fetched)
+        metadata_cache.put_many(list(fetched.values()))
+
+        # Serve expired cached data for anything Spotify could not return
+        unresolved = [key for key in keys if key not in found]
+        if unresolved:
+            found.update(metadata_cache.get_many(unresolved, allow_stale=True))
+
+    return [found[key] for key in keys if key in found]